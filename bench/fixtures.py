@@ -0,0 +1,208 @@
+# Pages for offline benchmarks: synthetic soccerstats.com and 24score.pro
+# sites shaped like the pages main.py and v2/soccer.py parse, pages recorded
+# in a ResponseCache directory, and a local HTTP server for either.
+
+import os
+import json
+import random
+import threading
+
+from datetime import date, timedelta
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+month_names = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+day_names = ["Mo", "Tu", "We", "Th", "Fr", "Sa", "Su"]
+scores = [(0, 0), (1, 1), (2, 2), (1, 0), (0, 1), (2, 1), (1, 2), (2, 0), (0, 2), (3, 1), (1, 3), (3, 0)]
+
+def _code(i):
+    # letters only, the v2 match row regex does not allow digits or hyphens in names
+    code = ""
+    while True:
+        code = chr(ord("a") + i % 26) + code
+        i = i // 26 - 1
+        if i < 0:
+            return code
+
+def _teams(league, n_teams):
+    return ["Club {} {}".format(_code(league), _code(team)) for team in range(n_teams)]
+
+def _schedule(teams, year1, rnd):
+    # double round robin, a round a week from mid August
+    rotation = list(teams)
+    n = len(rotation)
+    rounds = list()
+
+    for r in range(n - 1):
+        rounds.append([(rotation[i], rotation[n - 1 - i]) for i in range(n // 2)])
+        rotation = [rotation[0], rotation[-1]] + rotation[1:-1]
+    rounds += [[(team2, team1) for team1, team2 in pairs] for pairs in rounds]
+
+    start = date(year1, 8, 15)
+    for r, pairs in enumerate(rounds):
+        day = start + timedelta(weeks=r)
+        for team1, team2 in pairs:
+            yield day, team1, team2, rnd.choice(scores)
+
+class SyntheticSite(object):
+    def __init__(self, n_leagues, years, n_teams=16):
+        self.n_leagues = n_leagues
+        self.years = sorted(years, reverse=True)
+        self.n_teams = n_teams
+        self.today = date.today()
+
+    def matches(self, league, year1):
+        rnd = random.Random("{}-{}".format(league, year1))
+        return _schedule(_teams(league, self.n_teams), year1, rnd)
+
+class SoccerstatsSite(SyntheticSite):
+    # leagues.asp, latest.asp?league=l<i> with the season links and
+    # results.asp?league=l<i>_<year>&pmtype=bydate with the matches
+    def page(self, path):
+        url = urlparse(path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+
+        if url.path == "/leagues.asp":
+            return self.leagues_page()
+        if url.path == "/latest.asp" and "league" in params:
+            return self.league_page(int(params["league"][1:]))
+        if url.path == "/results.asp" and "league" in params:
+            league, year = params["league"][1:].split("_")
+            return self.results_page(int(league), int(year))
+        return None
+
+    def leagues_page(self):
+        rows = ["<tr><td><a href=\"latest.asp?league=l{0}\">Country {1} - <font>League {1}</font></a></td></tr>"
+                    .format(i, _code(i)) for i in range(self.n_leagues)]
+        return "<html><body><table class=\"sortable\"><tbody>{}</tbody></table></body></html>".format("".join(rows))
+
+    def league_page(self, league):
+        links = ["<a href=\"results.asp?league=l{}_{}&pmtype=bydate\">{}/{}</a>".format(league, year, year, str(year + 1)[2:])
+                    for year in self.years]
+        return "<html><body><div class=\"dropdown-content\">{}</div></body></html>".format("".join(links))
+
+    def results_page(self, league, year1):
+        # the current season lists played and upcoming matches as trow3 rows
+        is_current = self.years[0] == year1
+        rows = list()
+
+        for day, team1, team2, (score1, score2) in self.matches(league, year1):
+            score = "<font><b>{} - {}</b></font>".format(score1, score2) if day <= self.today or not is_current else ""
+            date_text = "{} {} {}".format(day_names[day.weekday()], day.day, month_names[day.month - 1])
+            rows.append("<tr class=\"{}\"><td><font>{}</font></td><td>15:00</td><td>{} - {}</td><td>{}</td></tr>"
+                            .format("trow3" if is_current else "odd", date_text, team1, team2, score))
+
+        return "<html><body><table id=\"btable\">{}</table></body></html>".format("".join(rows))
+
+class ScoreSite(SyntheticSite):
+    # the 24score.pro countries list, /league/l<i>/ with the season options,
+    # /league/l<i>/<year>/ with the data key of the standings loaded from
+    # the backend, and /team/<year>/l<i>/t<j>/ with the league match table
+    def __init__(self, n_leagues, years, n_teams=16, misspelled=0.05):
+        SyntheticSite.__init__(self, n_leagues, years, n_teams)
+        self.misspelled = misspelled
+
+    def page(self, path):
+        url = urlparse(path)
+        parts = [part for part in url.path.split("/") if part]
+
+        if not parts:
+            return self.leagues_page()
+        if parts[0] == "league" and len(parts) == 2:
+            return self.league_page(int(parts[1][1:]))
+        if parts[0] == "league" and len(parts) == 3:
+            return "<html><script>var page = {{\"data_key\" : \"{}_{}\"}};</script></html>".format(parts[1], parts[2])
+        if parts[0] == "backend":
+            league, year = parse_qs(url.query)["data_key"][0][1:].split("_")
+            return self.standings_page(int(league), int(year))
+        if parts[0] == "team" and len(parts) == 4:
+            return self.team_page(int(parts[2][1:]), int(parts[1]), int(parts[3][1:]))
+        return None
+
+    def leagues_page(self):
+        items = list()
+        for i in range(self.n_leagues):
+            items.append("<li title=\"Country {}\">Country</li>".format(_code(i)))
+            items.append("<li><a href=\"/league/l{}/\">Лига {}</a></li>".format(i, _code(i)))
+        return "<html><body><ul class=\"countries\">{}</ul></body></html>".format("".join(items))
+
+    def league_page(self, league):
+        options = ["<option value=\"/league/l{}/{}/\">{}-{}</option>".format(league, year, year, year + 1) for year in self.years]
+        return "<html><body><select class=\"sel_season\">{}</select></body></html>".format("".join(options))
+
+    def standings_page(self, league, year1):
+        rows = ["<tr><td class=\"left\"><a href=\"/team/{}/l{}/t{}/\">{}</a></td></tr>".format(year1, league, i, team)
+                    for i, team in enumerate(_teams(league, self.n_teams))]
+        return "<html><body><div class=\"data_0_all\"><table class=\"standings\">{}</table></div></body></html>".format("".join(rows))
+
+    def team_page(self, league, year1, team):
+        team_name = _teams(league, self.n_teams)[team]
+        options = ["<option value=\"/team/{}/l{}/t{}/\">{}-{}</option>".format(year, league, team, year, year + 1) for year in self.years]
+        rnd = random.Random("{}-{}-{}".format(league, year1, team))
+        rows = list()
+
+        for day, team1, team2, (score1, score2) in self.matches(league, year1):
+            if team_name not in (team1, team2):
+                continue
+            if rnd.random() < self.misspelled:
+                team1 += "." # resolved by the fuzzy path
+            rows.append("<tr><td>{}</td><td>{} - {}</td><td>{}:{}</td></tr>"
+                            .format(day.strftime("%d.%m.%Y"), team1, team2, score1, score2))
+
+        return ("<html><body><select class=\"sel_season\">{}</select><div id=\"all0\"><table>"
+                "<tr><th><a href=\"/league/l{}/{}/\">Лига {}</a></th></tr>{}</table></div></body></html>"
+                    .format("".join(options), league, year1, _code(league), "".join(rows)))
+
+class RecordedSite(object):
+    # serves the pages of a crawler.ResponseCache directory by path and query
+    def __init__(self, cache_dir):
+        self.pages = dict()
+
+        for root, dirs, files in os.walk(cache_dir):
+            for name in files:
+                if not name.endswith(".json"):
+                    continue
+                with open(os.path.join(root, name)) as f:
+                    url = urlparse(json.load(f)["url"])
+                key = url.path + ("?" + url.query if url.query else "")
+                self.pages[key] = os.path.join(root, name[:-len(".json")] + ".body")
+
+    def page(self, path):
+        body_path = self.pages.get(path)
+        if body_path is None:
+            return None
+        with open(body_path, "rb") as f:
+            return f.read()
+
+class FixtureServer(object):
+    def __init__(self, site):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = site.page(self.path)
+                if body is None:
+                    self.send_error(404)
+                    return
+
+                if isinstance(body, str):
+                    body = body.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = "http://127.0.0.1:{}".format(self.httpd.server_address[1])
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
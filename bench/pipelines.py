@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+# Offline benchmark of the soccerstats.com (main.py) and 24score.pro
+# (v2/soccer.py) pipelines against a local fixture server. Every pipeline
+# and scale runs in its own process, so the peak RSS is its own; the peak
+# of the parse workers of the pipelined stage is reported separately:
+#
+#   python bench/pipelines.py                                 # both pipelines, 1, 10 and 100 leagues
+#   python bench/pipelines.py --pipeline v2 --leagues 10 --seasons 3
+#   python bench/pipelines.py --out run.json --baseline previous.json
+#   python bench/pipelines.py --pipeline main --recorded cache --leagues 0
+#
+# Stage times of the crawls are summed over threads, so with concurrent
+# fetches they exceed the wall time. The server shares the process with
+# the pipeline, compare runs made on the same machine only.
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import resource
+import functools
+import contextlib
+import subprocess
+
+from datetime import datetime
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+root_dir = os.path.dirname(bench_dir)
+
+def _stage_seconds(metrics):
+    return {stage: span["seconds"] for stage, span in metrics.snapshot()["spans"].items()}
+
+def _peak_rss_kb(who=resource.RUSAGE_SELF):
+    return resource.getrusage(who).ru_maxrss
+
+def _measured(parse, item, page):
+    # runs in a parse worker, which is a child of the fork server rather
+    # than of this process, so it reports its own peak with the result
+    return parse(item, page), _peak_rss_kb()
+
+def _measure_workers(crawler):
+    # wraps Crawler.pipeline, returns a list that holds the peak RSS of
+    # its parse workers
+    peak = [0]
+    pipeline = crawler.pipeline
+
+    def measured(fetch, parse, items, workers=None):
+        results = list()
+        for result, err in pipeline(fetch, functools.partial(_measured, parse), items, workers):
+            if result is not None:
+                result, rss = result
+                peak[0] = max(peak[0], rss)
+            results.append((result, err))
+        return results
+
+    crawler.pipeline = measured
+    return peak
+
+def _site(pipeline, n_leagues, years, recorded):
+    from fixtures import SoccerstatsSite, ScoreSite, RecordedSite
+
+    if recorded:
+        return RecordedSite(recorded)
+    if pipeline == "main":
+        return SoccerstatsSite(n_leagues, years)
+    return ScoreSite(n_leagues, years)
+
+def run_main(n_leagues, n_seasons, recorded, work_dir):
+    sys.path.insert(0, root_dir)
+    import settings
+    import main
+    from crawler import Crawler, HttpClient
+    from store import MatchStore
+    from metrics import metrics as stages
+
+    main.infologger.setLevel("WARNING")
+    year = settings.get_season_year(main.date2season(datetime.now()))
+    seasons = [main.year2season(year - y) for y in range(n_seasons)]
+
+    with FixtureServerFor("main", n_leagues, [year - y for y in range(n_seasons)], recorded) as server:
+        # no politeness delays against the local server
+        settings.base_uri = main.base_uri = server.url
+        main.leagues_uri = "/".join((server.url, "leagues.asp"))
+        main.client = HttpClient(rate=0, pool_size=settings.crawl_concurrency)
+        main.crawler = Crawler(main.client, settings.crawl_concurrency)
+        workers_peak = _measure_workers(main.crawler)
+        main.client.get = stages.timed("fetch", main.client.get)
+
+        start = time.perf_counter()
+        leagues = main.load_leagues_info()
+        tasks = [task for season in seasons for task in main._leagues_matches_tasks(leagues, season)]
+        pages = main.crawler.map(lambda task: main._fetch_matches_page(task).content, tasks)
+
+        results = list()
+        with stages.span("parse"):
+            for task, (content, err) in zip(tasks, pages):
+                if err is None:
+                    matches, future_matches, stats = main._parse_matches_page(task, content)
+                    results.append((task, (matches, future_matches)))
+
+        with stages.span("merge"):
+            for (country, league, season, uri), (matches, future_matches) in results:
+                info = leagues[country][league]
+                if main._is_current_season(season):
+                    info["future"] = future_matches
+                info.setdefault("matches", list()).extend(matches)
+            main._set_high_water_marks(leagues)
+
+        store = MatchStore(os.path.join(work_dir, "bench.db"))
+        with stages.span("store"):
+            main.save_data(store, leagues)
+
+        with stages.span("analyze"):
+            n_rows = sum(1 for row in main.calc_draw_stat(store, n_seasons, settings.meeting_matches))
+        wall = time.perf_counter() - start
+        n_pages = main.client.stats()["requests"]
+        seconds = _stage_seconds(stages)
+
+        # fetch and parse overlapped as in a real load, the spans main.py
+        # records itself from here on belong to the pipelined stage
+        for country in leagues:
+            for league in leagues[country]:
+                leagues[country][league].pop("matches", None)
+        start = time.perf_counter()
+        main._leagues_get_matches(leagues, seasons)
+        seconds["pipelined"] = time.perf_counter() - start
+
+    n_matches = sum(len(matches) for task, (matches, future_matches) in results)
+    return seconds, n_pages, n_matches, n_rows, wall, workers_peak[0]
+
+def run_v2(n_leagues, n_seasons, recorded, work_dir):
+    sys.path.insert(0, os.path.join(root_dir, "v2"))
+    import soccer
+    from crawler import HttpClient
+    from metrics import metrics as stages
+
+    now = datetime.now()
+    last_year = now.year - 1 if now.month >= 7 else now.year - 2 # last closed season
+    years = [last_year - y for y in range(n_seasons)]
+
+    with FixtureServerFor("v2", n_leagues, years, recorded) as server, \
+         open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        soccer.baseUrl = server.url + "/"
+        soccer.backendLoadPageDataUrl = soccer.JoinUrlPath(soccer.baseUrl, "/backend/load_page_data.php")
+        client = HttpClient(rate=0, pool_size=soccer.prefetchPages)
+        get = stages.timed("fetch", client.get)
+        client.get = soccer.requestHandler(lambda url, final=False, **kwargs: get(url, **kwargs))
+        soccer.sess = client
+
+        start = time.perf_counter()
+        leagues, leaguesPathes = soccer.LoadLeagues(soccer.baseUrl, client)
+        seasons = list()
+        allMatches = set()
+        for year in years:
+            matches, season = soccer.LoadSeasonMatches(year, year + 1, leagues, leaguesPathes)
+            allMatches.update(matches)
+            seasons.append(season)
+
+        with stages.span("analyze"):
+            series = soccer.GetTeamsDrawSeries(seasons, allMatches)
+            soccer.GetTeamsDrawStat(allMatches)
+        wall = time.perf_counter() - start
+
+    # parse includes the name resolution it triggers
+    seconds = _stage_seconds(stages)
+    seconds["parse"] = seconds.get("parse", 0.0) - seconds.get("resolve", 0.0)
+    return seconds, client.stats()["requests"], len(allMatches), len(series), wall, 0
+
+@contextlib.contextmanager
+def FixtureServerFor(pipeline, n_leagues, years, recorded):
+    from fixtures import FixtureServer
+
+    with FixtureServer(_site(pipeline, n_leagues, years, recorded)) as server:
+        yield server
+
+def run_child(args):
+    sys.path.insert(0, bench_dir)
+    run = run_main if args.pipeline == "main" else run_v2
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        os.chdir(work_dir) # the loggers of settings.py write to the working directory
+        seconds, n_pages, n_matches, n_rows, wall, workers_peak = run(args.leagues[0], args.seasons, args.recorded, work_dir)
+
+    result = {"pipeline" : args.pipeline,
+              "leagues" : args.leagues[0],
+              "seasons" : args.seasons,
+              "pages" : n_pages,
+              "matches" : n_matches,
+              "stat_rows" : n_rows,
+              "wall" : wall,
+              "pages_per_s" : n_pages / wall if wall else 0.0,
+              "matches_per_s" : n_matches / wall if wall else 0.0,
+              "peak_rss_kb" : _peak_rss_kb(),
+              "workers_peak_rss_kb" : max(workers_peak, _peak_rss_kb(resource.RUSAGE_CHILDREN)),
+              "stages" : seconds}
+    print(json.dumps(result))
+
+def _key(result):
+    return (result["pipeline"], result["leagues"], result["seasons"])
+
+def report(results, baseline, threshold):
+    previous = {_key(result): result for result in baseline}
+    regressions = 0
+
+    for result in results:
+        line = "{pipeline:>4} {leagues:>4} leagues x {seasons} seasons: {pages:>6} pages {matches:>8} matches " \
+               "{pages_per_s:>8.1f} pages/s {matches_per_s:>10.1f} matches/s {peak_rss_kb:>8} KB peak " \
+               "{workers_peak_rss_kb:>8} KB workers".format(**dict({"workers_peak_rss_kb" : 0}, **result))
+        stages = " ".join("{} {:.2f}s".format(stage, seconds) for stage, seconds in sorted(result["stages"].items()))
+        print(line)
+        print("     " + stages)
+
+        old = previous.get(_key(result))
+        if old is None or not old["matches_per_s"]:
+            continue
+
+        change = result["matches_per_s"] / old["matches_per_s"] - 1
+        is_regression = change < -threshold
+        regressions += is_regression
+        print("     {:+.1%} matches/s against the baseline{}".format(change, " REGRESSION" if is_regression else ""))
+
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the scraper pipelines")
+    parser.add_argument("--pipeline", choices=["main", "v2", "all"], default="all")
+    parser.add_argument("--leagues", type=int, nargs="+", default=[1, 10, 100], help="synthetic leagues per run")
+    parser.add_argument("--seasons", type=int, default=3)
+    parser.add_argument("--recorded", help="serve the pages of a response cache directory instead")
+    parser.add_argument("--out", help="write the results as json")
+    parser.add_argument("--baseline", help="json results of a previous run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1, help="matches/s drop reported as a regression")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args)
+        return
+
+    pipelines = ["main", "v2"] if args.pipeline == "all" else [args.pipeline]
+    results = list()
+
+    for pipeline in pipelines:
+        for n_leagues in args.leagues:
+            command = [sys.executable, os.path.abspath(__file__), "--child", "--pipeline", pipeline,
+                       "--leagues", str(n_leagues), "--seasons", str(args.seasons)]
+            if args.recorded:
+                command += ["--recorded", os.path.abspath(args.recorded)]
+
+            output = subprocess.run(command, stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+
+    baseline = list()
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    regressions = report(results, baseline, args.threshold)
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=1)
+
+    sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# Compares the row text extraction of ParseLeagueMatchTable, the recursive
+# GetAllTextFromHtmlElement path against GetRowText, on saved team pages:
+#
+#   python bench/row_text.py team1.html [team2.html ...]
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "v2"))
+
+from lxml import html
+from soccer import GetAllTextFromHtmlElement, MatchFilterFunc, GetRowText, matchRe
+
+def recursiveRowText(row):
+    return "".join([GetAllTextFromHtmlElement(node, MatchFilterFunc) for node in row.xpath(".//td")])
+
+def parseRows(rows, rowText):
+    return [tuple(i.strip() for i in params) for row in rows for params in matchRe.findall(rowText(row))]
+
+def bench(rows, rowText, repeat):
+    start = time.perf_counter()
+    for i in range(repeat):
+        parseRows(rows, rowText)
+    return (time.perf_counter() - start) / repeat
+
+def main(pathes, repeat=20):
+    rows = list()
+    for path in pathes:
+        doc = html.parse(path).getroot()
+        rows += doc.xpath(".//div[@id=\"all0\"]/table//tr")
+
+    if not len(rows):
+        print("No match rows found")
+        return
+
+    old, new = parseRows(rows, recursiveRowText), parseRows(rows, GetRowText)
+    if old != new:
+        print("Parsed matches differ: {} recursive, {} single pass".format(len(old), len(new)))
+
+    oldTime = bench(rows, recursiveRowText, repeat)
+    newTime = bench(rows, GetRowText, repeat)
+
+    print("{} rows, {} matches".format(len(rows), len(new)))
+    print("GetAllTextFromHtmlElement: {:.0f} rows/s".format(len(rows) / oldTime))
+    print("GetRowText:                {:.0f} rows/s ({:.1f}x)".format(len(rows) / newTime, oldTime / newTime))
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: {} team_page.html [team_page.html ...]".format(sys.argv[0]))
+        sys.exit(1)
+    main(sys.argv[1:])
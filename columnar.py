@@ -0,0 +1,122 @@
+import numpy as np
+
+# datetime64[D] counts days from 1970-01-01, date.toordinal() from 0001-01-01
+epoch_ordinal = 719163
+
+class MatchTable(object):
+    # column oriented match history: one entry per match, teams and leagues
+    # are interned to integer ids, names are kept in self.teams and self.leagues
+    def __init__(self, teams, leagues, team1, team2, dates, score1, score2, seasons, league_ids):
+        self.teams = teams
+        self.leagues = leagues
+        self.team1 = team1
+        self.team2 = team2
+        self.dates = dates
+        self.score1 = score1
+        self.score2 = score2
+        self.seasons = seasons
+        self.league_ids = league_ids
+
+    @classmethod
+    def from_rows(cls, rows):
+        # rows: (team1, team2, date ordinal, score1, score2, season year, league)
+        team_ids = dict()
+        league_ids = dict()
+        columns = ([], [], [], [], [], [], [])
+
+        for team1, team2, date, score1, score2, season, league in rows:
+            columns[0].append(team_ids.setdefault(team1, len(team_ids)))
+            columns[1].append(team_ids.setdefault(team2, len(team_ids)))
+            columns[2].append(date)
+            columns[3].append(score1)
+            columns[4].append(score2)
+            columns[5].append(season)
+            columns[6].append(league_ids.setdefault(league, len(league_ids)))
+
+        return cls(list(team_ids), list(league_ids),
+                   np.array(columns[0], dtype=np.int32),
+                   np.array(columns[1], dtype=np.int32),
+                   (np.array(columns[2], dtype=np.int64) - epoch_ordinal).astype("datetime64[D]"),
+                   np.array(columns[3], dtype=np.int8),
+                   np.array(columns[4], dtype=np.int8),
+                   np.array(columns[5], dtype=np.int16),
+                   np.array(columns[6], dtype=np.int32))
+
+    def __len__(self):
+        return len(self.dates)
+
+    def draw_stat(self, date_to=None, season_from=None):
+        # Draw series of every team at once. A series is the run of non-draw
+        # matches finished by a draw, the current series is the run after the
+        # last draw. As in main.calc_draw_stat, a leading run without a draw
+        # is only counted if it is not empty.
+        mask = np.ones(len(self), dtype=bool)
+        if date_to is not None:
+            mask &= self.dates <= np.datetime64(date_to - epoch_ordinal, "D")
+        if season_from is not None:
+            mask &= self.seasons >= season_from
+
+        team = np.concatenate((self.team1[mask], self.team2[mask]))
+        dates = np.concatenate((self.dates[mask], self.dates[mask]))
+        is_draw = np.tile(self.score1[mask] == self.score2[mask], 2)
+        league = np.tile(self.league_ids[mask], 2)
+        n_teams = len(self.teams)
+
+        order = np.lexsort((dates, team))
+        team = team[order]
+        is_draw = is_draw[order]
+        league = league[order]
+
+        n_matches = np.bincount(team, minlength=n_teams)
+        n_draws = np.bincount(team, weights=is_draw, minlength=n_teams)
+        team_start = np.cumsum(n_matches) - n_matches
+        team_end = team_start + n_matches
+
+        # run-length encoding over the sorted appearances: the runs of
+        # non-draws are the differences of the non-draw counter taken at the
+        # positions of the draws of a team
+        not_draw = (~is_draw).astype(np.int64)
+        counter = np.cumsum(not_draw)
+        before = counter - not_draw
+
+        draws = np.flatnonzero(is_draw)
+        draw_team = team[draws]
+        first = np.ones(len(draws), dtype=bool)
+        first[1:] = draw_team[1:] != draw_team[:-1]
+        last = np.ones(len(draws), dtype=bool)
+        last[:-1] = draw_team[:-1] != draw_team[1:]
+
+        previous = np.empty(len(draws), dtype=np.int64)
+        previous[1:] = counter[draws[:-1]]
+        previous[first] = before[team_start[draw_team[first]]]
+        runs = counter[draws] - previous
+
+        counted = ~(first & (runs == 0))
+        runs = runs[counted]
+        run_team = draw_team[counted]
+
+        n_series = np.bincount(run_team, minlength=n_teams)
+        sum_series = np.bincount(run_team, weights=runs, minlength=n_teams)
+        max_series = np.zeros(n_teams, dtype=np.int64)
+        np.maximum.at(max_series, run_team, runs)
+
+        # teams without draws have only the current series
+        curr_series = n_matches.astype(np.int64)
+        last_team = draw_team[last]
+        curr_series[last_team] = counter[team_end[last_team] - 1] - counter[draws[last]]
+
+        mean_series = np.where(n_series > 0, sum_series / np.maximum(n_series, 1), 0.0)
+        draw_rate = np.where(n_matches > 0, n_draws / np.maximum(n_matches, 1), 0.0)
+
+        last_league = np.full(n_teams, -1, dtype=np.int64)
+        has_matches = n_matches > 0
+        last_league[has_matches] = league[(team_end - 1)[has_matches]]
+
+        return {"team" : np.arange(n_teams)[has_matches],
+                "league" : last_league[has_matches],
+                "n_matches" : n_matches[has_matches],
+                "n_series" : n_series[has_matches],
+                "max_series" : max_series[has_matches],
+                "mean_series" : mean_series[has_matches],
+                "curr_series" : curr_series[has_matches],
+                "draw_rate" : draw_rate[has_matches]}
@@ -0,0 +1,318 @@
+import os
+import json
+import time
+import random
+import hashlib
+import threading
+import requests
+import multiprocessing
+
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
+class TokenBucket(object):
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    def reserve(self):
+        # takes a token, possibly in advance, and returns how long to wait for it
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= 1
+
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+class RateLimiter(object):
+    # a token bucket per host
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.buckets = dict()
+
+    def wait(self, url):
+        if not self.rate:
+            return
+
+        host = urlparse(url).netloc
+        with self.lock:
+            bucket = self.buckets.setdefault(host, TokenBucket(self.rate, self.burst))
+            delay = bucket.reserve()
+
+        if delay > 0:
+            time.sleep(delay)
+
+    def feedback(self, url, latency, status):
+        pass
+
+class AdaptiveRateLimiter(RateLimiter):
+    # AIMD rate per host: the rate grows by step after every fast successful
+    # response and is halved on errors, 429/5xx or responses slower than
+    # target_latency; a global bucket keeps all hosts within budget
+    def __init__(self, rate, max_rate, min_rate=0.2, target_latency=2.0, step=0.1, budget=None, burst=1):
+        RateLimiter.__init__(self, rate, burst)
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.target_latency = target_latency
+        self.step = step
+        self.budget = TokenBucket(budget, burst) if budget else None
+
+    def wait(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            bucket = self.buckets.setdefault(host, TokenBucket(self.rate, self.burst))
+            delay = bucket.reserve()
+            if self.budget:
+                delay = max(delay, self.budget.reserve())
+
+        if delay > 0:
+            time.sleep(delay)
+
+    def feedback(self, url, latency, status):
+        host = urlparse(url).netloc
+        with self.lock:
+            bucket = self.buckets.setdefault(host, TokenBucket(self.rate, self.burst))
+            if status is None or status == 429 or status >= 500 or latency > self.target_latency:
+                bucket.rate = max(self.min_rate, bucket.rate / 2)
+            else:
+                bucket.rate = min(self.max_rate, bucket.rate + self.step)
+
+    def rates(self):
+        with self.lock:
+            return {host : bucket.rate for host, bucket in self.buckets.items()}
+
+class HttpClient(object):
+    # keep-alive session shared by all threads with per host rate limiting,
+    # retries with exponential backoff and jitter, and request counters
+    retry_statuses = set([429, 500, 502, 503, 504])
+
+    def __init__(self, rate=4.0, burst=1, pool_size=8, timeout=30, retries=3, backoff=0.5, headers=None, limiter=None):
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if headers:
+            self.session.headers.update(headers)
+
+        self.limiter = limiter if limiter is not None else RateLimiter(rate, burst)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+
+        self.lock = threading.Lock()
+        self.counters = {"requests" : 0, "retries" : 0, "errors" : 0, "bytes" : 0,
+                         "latency_total" : 0.0, "latency_max" : 0.0}
+
+    def _count(self, latency, response=None, retry=False):
+        with self.lock:
+            self.counters["requests"] += 1
+            self.counters["latency_total"] += latency
+            self.counters["latency_max"] = max(self.counters["latency_max"], latency)
+            if response is None:
+                self.counters["errors"] += 1
+            else:
+                self.counters["bytes"] += len(response.content)
+            if retry:
+                self.counters["retries"] += 1
+
+    def _retry_delay(self, attempt, response):
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return float(retry_after)
+        return self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+
+        for attempt in range(self.retries + 1):
+            self.limiter.wait(url)
+            start = time.monotonic()
+            response, error = None, None
+
+            try:
+                response = self.session.get(url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+
+            latency = time.monotonic() - start
+            status = response.status_code if response is not None else None
+            retry = attempt < self.retries and (error is not None or status in self.retry_statuses)
+            self._count(latency, response, retry)
+            self.limiter.feedback(url, latency, status)
+
+            if not retry:
+                break
+            time.sleep(self._retry_delay(attempt, response))
+
+        if error is not None:
+            raise error
+        return response
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+
+        stats["latency_mean"] = stats["latency_total"] / stats["requests"] if stats["requests"] else 0.0
+        return stats
+
+class CachedResponse(object):
+    def __init__(self, url, content, encoding, headers, changed=True):
+        self.url = url
+        self.status_code = 200
+        self.content = content
+        self.encoding = encoding
+        self.headers = headers
+        self.changed = changed # False if the body was served from cache or revalidated with 304
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding or "utf-8", errors="replace")
+
+class ResponseCache(object):
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.counters = {"hits" : 0, "revalidated" : 0, "misses" : 0}
+
+    def _count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def stats(self):
+        # hits are served from disk, revalidated got a 304, misses a new body
+        with self.lock:
+            return dict(self.counters)
+
+    def _entry_path(self, key):
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.path, digest[:2], digest)
+
+    def _load(self, key):
+        entry_path = self._entry_path(key)
+        try:
+            with open(entry_path + ".json") as f:
+                meta = json.load(f)
+            with open(entry_path + ".body", "rb") as f:
+                content = f.read()
+        except (OSError, ValueError):
+            return None, None
+
+        if meta.get("url") != key:
+            return None, None
+
+        return meta, content
+
+    def _write(self, path, data, mode):
+        tmp_path = "{}.{}.tmp".format(path, threading.get_ident())
+        with open(tmp_path, mode) as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _store(self, key, meta, content=None):
+        entry_path = self._entry_path(key)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+
+        if content is not None:
+            self._write(entry_path + ".body", content, "wb")
+        self._write(entry_path + ".json", json.dumps(meta), "w")
+
+    def fetch(self, get, url, final=False, revalidate=False, **kwargs):
+        # final pages (closed seasons) never expire, others are revalidated
+        # with ETag/Last-Modified once they are older than ttl or on demand
+        meta, content = self._load(url)
+        now = time.time()
+
+        if meta is not None:
+            is_fresh = (now - meta["fetched"]) < self.ttl
+            if meta["final"] or (is_fresh and not revalidate):
+                self._count("hits")
+                return CachedResponse(url, content, meta["encoding"], meta["headers"], changed=False)
+
+            headers = dict(kwargs.pop("headers", None) or dict())
+            if meta["headers"].get("ETag"):
+                headers["If-None-Match"] = meta["headers"]["ETag"]
+            if meta["headers"].get("Last-Modified"):
+                headers["If-Modified-Since"] = meta["headers"]["Last-Modified"]
+            kwargs["headers"] = headers
+
+        r = get(url, **kwargs)
+
+        if r.status_code == 304 and meta is not None:
+            meta["fetched"] = now
+            meta["final"] = final
+            self._store(url, meta)
+            self._count("revalidated")
+            return CachedResponse(url, content, meta["encoding"], meta["headers"], changed=False)
+
+        r.raise_for_status()
+
+        headers = {k: r.headers[k] for k in ("ETag", "Last-Modified") if k in r.headers}
+        encoding = r.encoding or r.apparent_encoding
+        meta = {"url" : url, "fetched" : now, "final" : final,
+                "encoding" : encoding, "headers" : headers}
+
+        self._store(url, meta, r.content)
+        self._count("misses")
+        return CachedResponse(url, r.content, encoding, headers)
+
+class Crawler(object):
+    def __init__(self, client, concurrency=8, cache=None):
+        self.client = client
+        self.concurrency = concurrency
+        self.cache = cache
+
+    def get(self, uri, final=False, revalidate=False, **kwargs):
+        if self.cache is None:
+            return self.client.get(uri, **kwargs)
+        return self.cache.fetch(self.client.get, uri, final, revalidate, **kwargs)
+
+    def map(self, func, items):
+        # returns (result, error) pairs in the order of items
+        def call(item):
+            try:
+                return func(item), None
+            except Exception as e:
+                return None, e
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            return list(pool.map(call, items))
+
+    def pipeline(self, fetch, parse, items, workers=None):
+        # fetches items concurrently and hands every page to a process pool
+        # as soon as it arrives, pages fetched as None are not parsed;
+        # returns (result, error) pairs in the order of items. The parse
+        # workers start on the first page, while fetch threads hold session,
+        # limiter and logging locks, so they are not forked from this process.
+        results = [None] * len(items)
+        context = multiprocessing.get_context("forkserver")
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as fetch_pool, \
+             ProcessPoolExecutor(max_workers=workers, mp_context=context) as parse_pool:
+            fetched = {fetch_pool.submit(fetch, item): i for i, item in enumerate(items)}
+            parsed = dict()
+
+            for future in as_completed(fetched):
+                i = fetched[future]
+                try:
+                    page = future.result()
+                    if page is None:
+                        results[i] = (None, None)
+                    else:
+                        parsed[i] = parse_pool.submit(parse, items[i], page)
+                except Exception as e:
+                    results[i] = (None, e)
+
+            for i, future in parsed.items():
+                try:
+                    results[i] = (future.result(), None)
+                except Exception as e:
+                    results[i] = (None, e)
+
+        return results
@@ -3,15 +3,26 @@
 import os
 import re
 import sys
+import csv
 import json
-import requests
+import time
+import heapq
+import logging
+import itertools
 
+from io import BytesIO
 from datetime import datetime
 from lxml import etree, html
 from settings import *
+from crawler import Crawler, HttpClient, ResponseCache
+from store import MatchStore, Match, Fixture
+from metrics import metrics, profiled
+
+client = HttpClient(crawl_host_rate, crawl_host_burst, crawl_concurrency, request_timeout, request_retries, retry_backoff)
+crawler = Crawler(client, crawl_concurrency, ResponseCache(cache_dir, cache_ttl))
 
 def _league_get_seasons(league_uri):
-    data = html.fromstring(requests.get(league_uri).text)
+    data = html.fromstring(crawler.get(league_uri).text)
     anchors = data.xpath(".//div[@class='dropdown-content']/a")
     season_refs = dict()
     
@@ -25,10 +36,12 @@ def _league_get_seasons(league_uri):
             
     return season_refs
 
-def load_leagues_info():
-    data = html.fromstring(requests.get(leagues_uri).text)
+def _load_league_rows():
+    # (country, league, league_uri) of the leagues index, the page is
+    # revalidated once it is older than cache_ttl
+    data = html.fromstring(crawler.get(leagues_uri).text)
     rows = data.xpath(".//table[@class='sortable']/tbody/tr")
-    leagues = dict()
+    league_rows = list()
     
     for row in rows:
         try:
@@ -38,17 +51,31 @@ def load_leagues_info():
             href = anchor.attrib["href"]
             country = anchor.text.strip(" -")
             league  = row.xpath("./a/font")[0].text
-            
-            leagues.setdefault(country, dict())
             league_uri = "/".join((base_uri, href))
-
-            season_refs = _league_get_seasons(league_uri)
-            leagues[country][league] = {"url" : league_uri,
-                                        "seasons" : season_refs}
+            league_rows.append((country, league, league_uri))
             
         except Exception as e:
             infologger.info(str(e))
 
+    return league_rows
+
+def load_leagues_info(league_rows=None):
+    if league_rows is None:
+        league_rows = _load_league_rows()
+
+    leagues = dict()
+    league_uris = [league_uri for _, _, league_uri in league_rows]
+    results = crawler.map(_league_get_seasons, league_uris)
+
+    for (country, league, league_uri), (season_refs, err) in zip(league_rows, results):
+        if err:
+            infologger.info(str(err))
+            continue
+
+        leagues.setdefault(country, dict())
+        leagues[country][league] = {"url" : league_uri,
+                                    "seasons" : season_refs}
+
     return leagues
 
 def season2date(date, season):
@@ -60,9 +87,10 @@ def season2date(date, season):
     if month in second_half_months:
         year += 1
 
-    date = " ".join((str(year), month, day))
-    
-    return datetime.strptime(date, "%Y %b %d").strftime("%Y-%m-%d")
+    return datetime(year, month_numbers[month], int(day)).toordinal()
+
+def year2season(year):
+    return "/".join((str(year), str(year + 1)[-2:]))
 
 def date2season(date):
     year = date.year
@@ -76,339 +104,478 @@ def date2season(date):
 def _is_current_season(season):
     return date2season(datetime.now()) == season
 
+def _split_comands(comands):
+    comand = comands.split("-")
+    return comand[0].strip(), comand[-1].strip()
+
 def _unified_column_map(columns, season):
     date = columns[0].xpath(".//font")[0].text.strip()
     date = season2date(date, season)
-    comands = columns[2].text.strip()
-    score = None
+    comand1, comand2 = _split_comands(columns[2].text.strip())
+    season = get_season_year(season)
 
     try:
         score = columns[3].xpath(".//font/b")[0].text.strip()
     except:
-        pass
+        return Fixture(date, comand1, comand2, season)
+
+    scores = score.split("-")
+    return Match(date, comand1, comand2, season, int(scores[0]), int(scores[-1]))
+
+def _iter_match_rows(content, row_class):
+    # streams the rows of table#btable from the raw page, every row is
+    # cleared together with the rows before it once the consumer is done
+    for event, row in etree.iterparse(BytesIO(content), events=("end",), tag="tr", html=True):
+        table = row.getparent()
+        if table is None or table.tag != "table" or table.get("id") != "btable":
+            continue
 
-    return (date, comands, season), score
+        if row.get("class") == row_class:
+            yield row
 
-def _leagues_get_matches(leagues, season):
-    infologger.info("Loading matches for {} season...".format(season))
+        row.clear()
+        while row.getprevious() is not None:
+            del table[0]
+
+def _parse_matches_page(task, content):
+    # runs in a parse worker, so its figures go back with the result
+    start = time.perf_counter()
+    country, league, season, matches_uri = task
     is_current_season = _is_current_season(season)
+    today = datetime.now().toordinal()
+    future_matches = list()
+    n_rejected = 0
 
-    for country in leagues:
-        for league in leagues[country]:
-            league_seasons = leagues[country][league]["seasons"]
-            if season not in league_seasons:
-                infologger.info("Season {} not in league country {} seasons!".format(season, country, league))
-                infologger.info(json.dumps(league_seasons))
-                continue
-
-            league_tag = re.findall(league_tag_re, league_seasons[season])
-            if not len(league_tag):
-                infologger.info("Could not extract league tag from uri")
-                infologger.info(league_seasons[season])
-                continue
-
-            league_tag = league_tag[0]
-            matches_uri = get_match_uri(league_tag)
-            data = html.fromstring(requests.get(matches_uri).text)
-
-            if is_current_season:
-                future_matches = list()
-                rows = data.xpath(".//table[@id='btable']/tr[@class='trow3']")
-            else:
-                rows = data.xpath(".//table[@id='btable']/tr[@class='odd']")
-            
-            matches = list()
-            for row in rows:
-                columns = row.xpath(".//td")
-                n_columns = len(columns)
+    if is_current_season:
+        rows = _iter_match_rows(content, "trow3")
+    else:
+        rows = _iter_match_rows(content, "odd")
+    
+    matches = list()
+    for row in rows:
+        columns = row.xpath(".//td")
 
-                try:
-                    match_data, score = _unified_column_map(columns, season)
-                    if score != None:
-                        matches.append((*match_data, score))
-                    
-                    else:
-                        match_date = datetime.strptime(match_data[0], "%Y-%m-%d")
-                        is_future = (match_date >= datetime.now())
-
-                        if is_current_season and is_future:
-                            future_matches.append(match_data)
-                        else:
-                            raise Exception()
-                except:
-                    infologger.info("Columns doesn't match defined pattern!")
-                    infologger.info(etree.tostring(row,  pretty_print=True))
-
-            if is_current_season:
-                leagues[country][league]["future"] = future_matches
+        try:
+            match = _unified_column_map(columns, season)
+            if isinstance(match, Match):
+                matches.append(match)
             
-            leagues[country][league].setdefault("matches", list())
-            leagues[country][league]["matches"] += matches
-
-def get_comands_info(leagues):
-    comands = dict()
+            else:
+                is_future = (match.date > today)
+
+                if is_current_season and is_future:
+                    future_matches.append(match)
+                else:
+                    raise Exception()
+        except:
+            n_rejected += 1
+            if infologger.isEnabledFor(logging.DEBUG):
+                infologger.debug("Columns doesn't match defined pattern!")
+                infologger.debug(etree.tostring(row,  pretty_print=True))
+
+    stats = {"rows" : len(matches) + len(future_matches) + n_rejected,
+             "rejected" : n_rejected,
+             "seconds" : time.perf_counter() - start}
+    return matches, future_matches, stats
+
+def _league_matches_task(leagues, country, league, season):
+    league_seasons = leagues[country][league]["seasons"]
+    if season not in league_seasons:
+        infologger.info("Season {} not in league country {} seasons!".format(season, country, league))
+        infologger.info(json.dumps(league_seasons))
+        return None
+
+    league_tag = re.findall(league_tag_re, league_seasons[season])
+    if not len(league_tag):
+        infologger.info("Could not extract league tag from uri")
+        infologger.info(league_seasons[season])
+        return None
+
+    league_tag = league_tag[0]
+    return (country, league, season, get_match_uri(league_tag))
+
+def _leagues_matches_tasks(leagues, season):
+    tasks = list()
 
     for country in leagues:
         for league in leagues[country]:
-            if "matches"  in leagues[country][league]:
-                matches = sorted(leagues[country][league]["matches"], key=lambda x:x[0], reverse=True)
-                for match in matches:
-                    comand = match[1].split("-")
-                    comand1 = comand[0].strip()
-                    comand2 = comand[-1].strip()
-                    scores  = match[-1].split("-")
-                    score1  = scores[0].strip()
-                    score2  = scores[-1].strip()
-
-                    data1 = (league, country, comand2, (score1, score2), match[2], match[0])
-                    data2 = (league, country, comand1, (score2, score1), match[2], match[0])
-
-                    comands.setdefault(comand1, {"matches" : list()})
-                    comands.setdefault(comand2, {"matches" : list()})
-                    comands[comand1].setdefault("matches", list())
-                    comands[comand2].setdefault("matches", list())
-
-                    comands[comand1]["matches"].append(data1)
-                    comands[comand2]["matches"].append(data2)
-            
-            else:
-                infologger.info("{} {} league has no matches yet ?!".format(country, league))
+            task = _league_matches_task(leagues, country, league, season)
+            if task:
+                tasks.append(task)
 
-            if "future" in leagues[country][league]:
-                future_matches = sorted(leagues[country][league]["future"], key=lambda x:x[0], reverse=True)
-                for match in future_matches:
-                    comand = match[1].split("-")
-                    comand1 = comand[0].strip()
-                    comand2 = comand[-1].strip()
+    return tasks
 
-                    comands.setdefault(comand1, {"future" : list()})
-                    comands.setdefault(comand2, {"future" : list()})
-                    comands[comand1].setdefault("future", list())
-                    comands[comand2].setdefault("future", list())
+def _fetch_matches_page(task, revalidate=False):
+    country, league, season, matches_uri = task
+    return crawler.get(matches_uri, final=not _is_current_season(season), revalidate=revalidate)
 
-                    data1 = (league, country, comand2, match[2], match[0])
-                    data2 = (league, country, comand1, match[2], match[0])
+def _load_matches_pages(tasks, fetch):
+    results = crawler.pipeline(metrics.timed("fetch", fetch), _parse_matches_page, tasks, parse_workers)
 
-                    comands[comand1]["future"].append(data1)
-                    comands[comand2]["future"].append(data2)
+    for task, (result, err) in zip(tasks, results):
+        if err:
+            infologger.info("Could not load matches from {}: {}".format(task[-1], str(err)))
+            continue
 
-    return comands
+        if result is None: # page did not change since the last fetch
+            continue
 
-def _last_n_season_matches(comands, comand, n_seasons, datefrom=None):
-    if not datefrom:
-        datefrom = datetime.now()
+        matches, future_matches, stats = result
+        metrics.add("parse", stats["seconds"])
+        metrics.count("rows_parsed", stats["rows"])
+        metrics.count("rows_rejected", stats["rejected"])
+        if stats["rejected"]:
+            infologger.info("{} rows of {} don't match the defined pattern".format(stats["rejected"], task[-1]))
+
+        yield task, (matches, future_matches)
+
+def _leagues_get_matches(leagues, seasons):
+    tasks = list()
+    for season in seasons:
+        infologger.info("Loading matches for {} season...".format(season))
+        tasks += _leagues_matches_tasks(leagues, season)
+
+    fetch = lambda task: _fetch_matches_page(task).content
+    for task, (matches, future_matches) in _load_matches_pages(tasks, fetch):
+        country, league, season, matches_uri = task
+        with metrics.span("merge"):
+            if _is_current_season(season):
+                leagues[country][league]["future"] = future_matches
+            
+            leagues[country][league].setdefault("matches", list())
+            leagues[country][league]["matches"] += matches
 
-    data = []
-    season = date2season(datefrom)
-    target_year = get_season_year(season) - n_seasons + 1
+def save_data(store, leagues):
+    with store:
+        for country in leagues:
+            for league in leagues[country]:
+                info = leagues[country][league]
+                store.save_league(country, league, info["url"], info["seasons"], info.get("last_date", 0))
 
-    for match in comands[comand]["matches"]:
-        mseason = match[-2]
-        mdate = datetime.strptime(match[-1], "%Y-%m-%d")
+                n_new = store.add_matches(country, league, info.get("matches", list()))
+                if n_new:
+                    infologger.info("{} {}: {} matches stored".format(country, league, n_new))
 
-        if datefrom < mdate:
-            continue
+                if "future" in info:
+                    store.set_future(country, league, info["future"])
 
-        if get_season_year(mseason) < target_year:
-            break
+def _legacy_records(leagues):
+    # soccer.json rows: (date, "comand1 - comand2", season, "score1 - score2")
+    for country in leagues:
+        for league in leagues[country]:
+            info = leagues[country][league]
+            matches = list()
 
-        data.append(match)
+            for date, comands, season, score in info.get("matches", list()):
+                try:
+                    scores = score.split("-")
+                    matches.append(Match(datetime.strptime(date, "%Y-%m-%d").toordinal(), *_split_comands(comands),
+                                         get_season_year(season), int(scores[0]), int(scores[-1])))
+                except ValueError:
+                    infologger.info("Could not parse score of {} {}".format(comands, score))
 
-    return data
+            info["matches"] = matches
+            info["future"] = [Fixture(datetime.strptime(date, "%Y-%m-%d").toordinal(), *_split_comands(comands),
+                                      get_season_year(season)) for date, comands, season in info.get("future", list())]
+
+    _set_high_water_marks(leagues)
+    return leagues
+
+def _set_high_water_marks(leagues):
+    for country in leagues:
+        for league in leagues[country]:
+            info = leagues[country][league]
+            matches = sorted(info.get("matches", list()), key=lambda x: x.date, reverse=True)
+            info["matches"] = matches
+            info["last_date"] = matches[0].date if len(matches) else 0
 
 def load_data_n_seasons(leagues, n_seasons):
     season = date2season(datetime.now())
     year = get_season_year(season)
-
-    _leagues_get_matches(leagues, season)
+    seasons = [season]
 
     for y in range(1, n_seasons):
-        season =  "/".join((str(year-y), str(year-y+1)[-2:]))
-        _leagues_get_matches(leagues, season)
+        seasons.append(year2season(year-y))
+
+    _leagues_get_matches(leagues, seasons)
+    _set_high_water_marks(leagues)
+
+def _merge_new_matches(info, matches):
+    # league matches are kept sorted by date, newest first, and last_date is
+    # the newest stored one; rows up to it are only taken if they are unknown
+    # rows of that day or matches that were pending in the future list,
+    # the store ignores rows it already has
+    last_date = info.get("last_date", 0)
+    old_matches = info.get("matches", list())
+    known = set(itertools.takewhile(lambda x: x.date == last_date, old_matches))
+    pending = set(info.get("future", list()))
+
+    new_matches = set()
+    for match in matches:
+        if match.date > last_date or (match not in known and (match.date == last_date or match[:4] in pending)):
+            new_matches.add(match)
 
-def update_data(leagues):
-    existed_matches = set()
-    last_date = ""
-    
-    for country in leagues:
-        for league in leagues[country]:
-            matches = sorted(leagues[country][league]["matches"], key=lambda x: x[0], reverse=True)
-            existed_matches.update(set(matches))
-            if matches[0][0] > last_date:
-                last_date = matches[0][0]
+    if not len(new_matches):
+        return 0
 
-    season = date2season(datetime.now())
-    last_season = date2season(datetime.strptime(last_date,"%Y-%m-%d"))
-    new_leagues = load_leagues_info()
+    new_matches = sorted(new_matches, key=lambda x: x.date, reverse=True)
+    info["matches"] = list(heapq.merge(new_matches, old_matches, key=lambda x: x.date, reverse=True))
+    info["last_date"] = max(last_date, new_matches[0].date)
 
-    if season != last_season:
-        year = get_season_year(season)
-        last_year = get_season_year(last_season)
-        load_data_n_seasons(new_leagues, year-last_year)
-    
-    else:
-        _leagues_get_matches(new_leagues, season)
+    return len(new_matches)
 
-    new_countries = set(new_leagues.keys()).difference(set(leagues.keys()))
-    for country in new_countries:
-        leagues.setdefault(country, dict())
+def update_data(leagues):
+    now = datetime.now()
+    today = now.toordinal()
+    season = date2season(now)
+    year = get_season_year(season)
 
-    for country in leagues:
-        new_league = set(new_leagues[country].keys()).difference(set(leagues[country].keys()))
-        for league in new_league:
-            leagues[country][league] = new_leagues[country][league]
+    # leagues that appeared in the index since the last run start with the current season
+    new_rows = [(country, league, league_uri) for country, league, league_uri in _load_league_rows()
+                    if league not in leagues.get(country, dict())]
+    for country, new_leagues in load_leagues_info(new_rows).items():
+        for league, info in new_leagues.items():
+            infologger.info("New league {} {}".format(country, league))
+            leagues.setdefault(country, dict())[league] = info
+
+    stale_leagues = [(country, league) for country in leagues for league in leagues[country]
+                        if season not in leagues[country][league]["seasons"]]
+    league_uris = [leagues[country][league]["url"] for country, league in stale_leagues]
+
+    for (country, league), (season_refs, err) in zip(stale_leagues, crawler.map(_league_get_seasons, league_uris)):
+        if err:
+            infologger.info(str(err))
+            continue
+        leagues[country][league]["seasons"] = season_refs
+
+    tasks = list()
+    due = set()
 
     for country in leagues:
         for league in leagues[country]:
-            leagues[country][league]["future"] = new_leagues[country][league]["future"]
-            if not len(leagues[country][league]["matches"]):
-                leagues[country][league]["matches"] = new_leagues[country][league]["matches"]
-                continue
+            info = leagues[country][league]
+            last_date = info.get("last_date", 0)
+            last_year = year
+            if last_date:
+                last_year = get_season_year(date2season(datetime.fromordinal(last_date)))
+
+            for y in range(min(last_year, year), year + 1):
+                task = _league_matches_task(leagues, country, league, year2season(y))
+                if task:
+                    tasks.append(task)
+
+            if any(fixture.date <= today for fixture in info.get("future", list())):
+                due.add((country, league))
+
+    def fetch(task):
+        r = _fetch_matches_page(task, revalidate=(task[:2] in due))
+        return r.content if r.changed else None
+
+    # the number of new matches is logged by save_data, which gets it from the store
+    n_changed = 0
+    for task, (matches, future_matches) in _load_matches_pages(tasks, fetch):
+        country, league, match_season, matches_uri = task
+        info = leagues[country][league]
+        with metrics.span("merge"):
+            _merge_new_matches(info, matches)
+
+            if _is_current_season(match_season):
+                info["future"] = future_matches
+
+        n_changed += 1
+
+    infologger.info("{} of {} league pages changed".format(n_changed, len(tasks)))
+
+def filter_comands(store):
+    return store.single_league_teams()
+
+def get_meeting_stat(meetings, comand1, comand2):
+    if comand1 < comand2:
+        return meetings.get((comand1, comand2), (0, 0, 0))
+
+    wins, loses, draws = meetings.get((comand2, comand1), (0, 0, 0))
+    return (loses, wins, draws)
+
+def _streak_draw_series(store, comands, n_seasons):
+    # draw streaks are persisted in the store, only matches stored since
+    # the previous run are folded into them
+    target_year = get_season_year(date2season(datetime.now())) - n_seasons + 1
+    store.update_streaks(target_year)
+    series = dict()
+
+    for comand, streak in store.streaks().items():
+        if comand not in comands:
+            continue
 
-            for match in new_leagues[country][league]["matches"]:
-                if match not in existed_matches:
-                    leagues[country][league]["matches"].append(match)
+        if streak.n_series:
+            max_series = streak.max_series
+            mean_series = streak.sum_series / streak.n_series
+        else:
+            max_series = 0.0
+            mean_series = 0.0
 
-            leagues[country][league]["matches"] = sorted(leagues[country][league]["matches"], key=lambda x: x[0], reverse=True)
+        series[comand] = (" ".join((streak.country, streak.league)), max_series, mean_series, streak.curr_series)
 
-def filter_comands(comands):
-    core_comands = set()
-    for comand in comands:
-        if "matches" not in comands[comand]:
-            continue
+    return series
 
-        matches = comands[comand]["matches"]
-        leagues = set([" ".join((match[0], match[1])) for match in matches])
-        seasons = set([match[-2] for match in matches]) 
+_match_tables = dict() # store path -> (matches version, MatchTable)
 
-        if len(leagues) == 1:
-            core_comands.add(comand)
-    return core_comands
+def _match_table(store):
+    # the columnar history is shared by the analyses of this process until
+    # the store gets new matches
+    from columnar import MatchTable
 
-def get_meeting_stat(comands, comand1, comand2):
-    if "matches" in comands[comand1]:
-        matches = comands[comand1]["matches"]
-    else:
-        return (0, 0, 0)
-    
-    matches = list(filter(lambda x: x[2] == comand2, matches))
-    
-    if not len(matches):
-        return (0, 0, 0)
-    
-    wins = 0
-    loses = 0
-    draws = 0
-    
-    for match in matches:
-        score1, score2 = match[-3]
-        if score1 > score2:
-            wins += 1
-        elif score1 < score2:
-            loses += 1
-        else:
-            draws += 1
-    
-    return (wins, loses, draws)
+    version = store.matches_version()
+    cached = _match_tables.get(store.path)
+    if cached is not None and cached[0] == version:
+        return cached[1]
 
-def calc_draw_stat(comands, n_seasons=4, m_matches=5):
-    cc = filter_comands(comands)
-    draw_stat = list()
+    rows = ((m.comand1, m.comand2, m.date, m.score1, m.score2, m.season, " ".join((country, league)))
+                for country, league, m in store.iter_matches())
+    table = MatchTable.from_rows(rows)
+    _match_tables[store.path] = (version, table)
+    return table
 
-    for comand in cc:
-        data = _last_n_season_matches(comands, comand, n_seasons)
-        data = sorted(data, key=lambda x:x[-1], reverse=True)
+def _columnar_draw_series(store, comands, n_seasons):
+    datefrom = datetime.now()
+    target_year = get_season_year(date2season(datefrom)) - n_seasons + 1
 
-        if not len(data):
-            infologger.info("No data for comand {}!".format(comand))
-            continue
+    table = _match_table(store)
+    stat = table.draw_stat(date_to=datefrom.toordinal(), season_from=target_year)
+    series = dict()
 
-        curr_series = 0
-        n_draws  = 0.0
-        draw_series = []
+    for i, team_id in enumerate(stat["team"]):
+        comand = table.teams[team_id]
+        if comand not in comands:
+            continue
 
-        for match in data:
-            score1, score2 = match[-3]
-            if score1 == score2:
-                draw_series.append(curr_series)
-                curr_series = 0
-                n_draws += 1
-            else:
-                curr_series += 1
-        
-        if curr_series:
-            draw_series.append(curr_series)
-            curr_series = 0
-            
-        curr_series = draw_series[0]
-        draw_series = draw_series[1:]
-        
-        if len(draw_series):
-            max_series = max(draw_series)
-            mean_series = sum(draw_series) / len(draw_series)
+        if stat["n_series"][i]:
+            max_series = int(stat["max_series"][i])
+            mean_series = float(stat["mean_series"][i])
         else:
             max_series = 0.0
             mean_series = 0.0
 
-        league = data[0][0]
-        country = data[0][1]
-        meeting_stat = list()
-        
-        if "future" in comands[comand]:
-            n_future_matches = len(comands[comand]["future"])
-            future_matches = sorted(comands[comand]["future"], key=lambda x: x[-1])
-            opponents = [match[2] for match in future_matches[:m_matches]]
-            
-            for opponent in opponents:
-                ms = get_meeting_stat(comands, comand, opponent)
-                meeting_stat.append("/".join([str(i) for i in ms]))
+        series[comand] = (table.leagues[stat["league"][i]], max_series, mean_series, int(stat["curr_series"][i]))
+
+    return series
+
+def _comand_draw_stat(future, meetings, comand, comand_series, m_matches):
+    league, max_series, mean_series, curr_series = comand_series
+    meeting_stat = list()
+    future_matches = future.get(comand, [])
     
-            ms_len = len(meeting_stat)
+    if len(future_matches):
+        n_future_matches = len(future_matches)
+        opponents = [match.opponent for match in future_matches[:m_matches]]
         
-            for i in range(0, m_matches-ms_len):
-                meeting_stat.append("0/0/0")
+        for opponent in opponents:
+            ms = get_meeting_stat(meetings, comand, opponent)
+            meeting_stat.append("/".join([str(i) for i in ms]))
 
-        else:
-            n_future_matches = 0
-            for i in range(0, m_matches):
-                meeting_stat.append("0/0/0")
+        ms_len = len(meeting_stat)
+    
+        for i in range(0, m_matches-ms_len):
+            meeting_stat.append("0/0/0")
+
+    else:
+        n_future_matches = 0
+        for i in range(0, m_matches):
+            meeting_stat.append("0/0/0")
+
+    delta = max_series - curr_series
+    return (league, comand , max_series, mean_series, curr_series, n_future_matches, delta, *meeting_stat)
 
-        delta = max_series - curr_series
-        mean_draws = float(n_draws)/len(data)
-        dstat = (" ".join((country,league)), comand , max_series, mean_series, curr_series, n_future_matches, delta, *meeting_stat)
+def calc_draw_stat(store, n_seasons=4, m_matches=5, columnar=False):
+    # Yields the stat rows in the order of the teams. m_matches=None gives
+    # meeting stats for every remaining fixture; fixtures and meetings are
+    # read from the store once for all teams
+    cc = filter_comands(store)
 
-        draw_stat.append(dstat)
+    if m_matches is None:
+        m_matches = store.max_team_future()
+
+    if columnar:
+        series = _columnar_draw_series(store, cc, n_seasons)
+    else:
+        series = _streak_draw_series(store, cc, n_seasons)
 
-    return draw_stat
+    future = store.future_index()
+    meetings = store.meeting_index()
 
-def write_stat(stat, stat_file):
+    for comand in sorted(cc):
+        if comand not in series:
+            infologger.info("No data for comand {}!".format(comand))
+            continue
+        yield _comand_draw_stat(future, meetings, comand, series[comand], m_matches)
+
+def _write_csv(headers, rows, stat_file):
+    with open(stat_file, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(headers)
+        for chunk in iter(lambda: list(itertools.islice(rows, stat_write_rows)), []):
+            writer.writerows(chunk)
+
+def _write_parquet(headers, rows, stat_file):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    types = [pa.string(), pa.string(), pa.float64(), pa.float64(), pa.int64(), pa.int64(), pa.float64()]
+    types += [pa.string()] * (len(headers) - len(types))
+    schema = pa.schema(list(zip(headers, types)))
+
+    with pq.ParquetWriter(stat_file, schema) as writer:
+        for chunk in iter(lambda: list(itertools.islice(rows, stat_write_rows)), []):
+            columns = [pa.array(column, type=t) for column, t in zip(zip(*chunk), types)]
+            writer.write_table(pa.Table.from_arrays(columns, schema=schema))
+
+def write_stat(stat, stat_file, m_matches):
+    # stat is any iterable of rows with m_matches meeting columns, written in
+    # chunks of stat_write_rows; a .parquet stat_file is written with
+    # pyarrow, anything else as csv
     headers = ["Лига", "Команда", "Максимальная серия", "Средняя серия", "Текущая серия", "Игр до конца сезона", "Дельта"]
-    h_len = len(headers)
-    mstat_len = len(stat[0]) - h_len
-    for i in range(0, mstat_len):
+    for i in range(0, m_matches):
         headers.append("Прошлые встречи {}".format(i+1))
+    rows = iter(stat)
 
-    with open(stat_file, "w") as f:
-        f.write(", ".join(headers)+"\n")
-        for s in stat:
-            f.write(", ".join([str(i) for i in s])+"\n")
+    if stat_file.endswith(".parquet"):
+        _write_parquet(headers, rows, stat_file)
+    else:
+        _write_csv(headers, rows, stat_file)
 
-def main():
-    if os.path.exists(json_file):
-        leagues = json.loads(json_file)
+def run(store):
+    if store.is_empty() and os.path.exists(json_file):
+        infologger.info("Importing {} into {}...".format(json_file, db_file))
+        with open(json_file) as f:
+            save_data(store, _legacy_records(json.loads(f.read())))
+
+    if not store.is_empty():
+        leagues = store.load_leagues()
         update_data(leagues)
 
     else:
         leagues = load_leagues_info()
         load_data_n_seasons(leagues, load_n_seasons)
         
-        with open(json_file, "w") as f:
-            f.write(json.dumps(leagues))
+    with metrics.span("store"):
+        save_data(store, leagues)
+    infologger.info("HTTP: {}".format(json.dumps(client.stats())))
+
+    m_matches = meeting_matches
+    if m_matches is None:
+        m_matches = store.max_team_future()
+
+    with metrics.span("analyze"):
+        draw_stat = calc_draw_stat(store, load_n_seasons, m_matches, columnar_stat)
+        write_stat(draw_stat, stat_file, m_matches)
+
+def main():
+    store = MatchStore(db_file)
 
-    comands = get_comands_info(leagues)
+    with profiled(profile_file, trace_memory) as memory:
+        run(store)
 
-    draw_stat = calc_draw_stat(comands)
-    write_stat(draw_stat, stat_file)
+    metrics.write(metrics_file, http=client.stats(), cache=crawler.cache.stats(), memory=memory)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,89 @@
+import json
+import time
+import cProfile
+import threading
+import contextlib
+import tracemalloc
+
+class Metrics(object):
+    # named timing spans (count and seconds summed over threads) and counters
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.spans = dict()
+        self.counters = dict()
+
+    def add(self, name, seconds, n=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            span = self.spans.setdefault(name, [0, 0.0])
+            span[0] += n
+            span[1] += seconds
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    @contextlib.contextmanager
+    def span(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def timed(self, name, func):
+        def wrapper(*args, **kwargs):
+            with self.span(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def snapshot(self):
+        with self.lock:
+            spans = {name: {"count" : n, "seconds" : seconds} for name, (n, seconds) in self.spans.items()}
+            return {"spans" : spans, "counters" : dict(self.counters)}
+
+    def write(self, path, **extra):
+        # one json document per run, extra sections such as http stats are added as is
+        data = self.snapshot()
+        data["time"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+        data.update(extra)
+
+        with open(path, "w") as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+
+@contextlib.contextmanager
+def profiled(profile_file=None, trace_memory=False):
+    # cProfile of the calling thread dumped to profile_file and the
+    # tracemalloc peak, both off unless asked for; yields a dict that gets
+    # the memory figures once the block is done
+    result = dict()
+    profiler = None
+
+    if profile_file:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if trace_memory:
+        tracemalloc.start()
+
+    try:
+        yield result
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_file)
+        if trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            result["memory_current"] = current
+            result["memory_peak"] = peak
+
+# the metrics of this process
+metrics = Metrics()
@@ -9,6 +9,8 @@ infologger.addHandler(logging.StreamHandler())
 base_uri = "https://www.soccerstats.com"
 leagues_uri = "/".join((base_uri, "leagues.asp"))
 second_half_months = set(["May", "Apr", "Mar", "Feb", "Jan"])
+month_numbers = {month: i + 1 for i, month in enumerate(["Jan", "Feb", "Mar", "Apr", "May", "Jun",
+                                                         "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"])}
 
 get_season_year = lambda x: int(x.split("/")[0])
 get_match_uri = lambda x: "/".join((base_uri, "results.asp?league={}&pmtype=bydate".format(x)))
@@ -16,8 +18,27 @@ get_match_uri = lambda x: "/".join((base_uri, "results.asp?league={}&pmtype=byda
 league_tag_re = re.compile("league=([^&]+)")
 season_re = re.compile("\d{4}\/\d{2}")
 
-json_file = "soccer.json"
-stat_file = "soccer.csv"
+json_file = "soccer.json" # legacy storage, imported into db_file on first run
+db_file = "soccer.db"
+stat_file = "soccer.csv" # written as parquet if named *.parquet, needs pyarrow
+stat_write_rows = 10000 # rows per written chunk
 load_n_seasons = 4
+meeting_matches = 5 # upcoming opponents with meeting stats, None for all remaining fixtures
+columnar_stat = False # compute draw series with numpy over all teams at once
+
+crawl_concurrency = 8
+crawl_host_rate = 4.0 # requests per second per host
+crawl_host_burst = 2
+request_timeout = 30
+request_retries = 3
+retry_backoff = 0.5 # seconds, doubled on every retry
+parse_workers = None # defaults to the number of cpus
+
+cache_dir = "cache"
+cache_ttl = 6 * 60 * 60 # seconds before pages of the current season are revalidated
+
+metrics_file = "soccer-metrics.json" # spans, counters and http/cache stats of the last run
+profile_file = None # cProfile stats of the main thread are dumped here if set, e.g. "soccer.prof"
+trace_memory = False # record the tracemalloc peak in metrics_file
 
 is_debug = True
\ No newline at end of file
@@ -0,0 +1,302 @@
+import json
+import sqlite3
+
+from datetime import datetime
+from collections import namedtuple
+
+# dates are proleptic Gregorian ordinals, seasons are the first year of the season
+Match = namedtuple("Match", ("date", "comand1", "comand2", "season", "score1", "score2"))
+Fixture = namedtuple("Fixture", ("date", "comand1", "comand2", "season"))
+TeamMatch = namedtuple("TeamMatch", ("league", "country", "opponent", "score", "opponent_score", "season", "date"))
+TeamFixture = namedtuple("TeamFixture", ("league", "country", "opponent", "season", "date"))
+Streak = namedtuple("Streak", ("league", "country", "last_date", "curr_series", "max_series", "sum_series", "n_series", "seen_draw"))
+
+schema_version = 2
+
+schema = """
+CREATE TABLE IF NOT EXISTS leagues (
+    country TEXT NOT NULL,
+    league TEXT NOT NULL,
+    url TEXT NOT NULL,
+    seasons TEXT NOT NULL,
+    last_date INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (country, league)
+);
+
+CREATE TABLE IF NOT EXISTS matches (
+    country TEXT NOT NULL,
+    league TEXT NOT NULL,
+    date INTEGER NOT NULL,
+    team1 TEXT NOT NULL,
+    team2 TEXT NOT NULL,
+    season INTEGER NOT NULL,
+    score1 INTEGER NOT NULL,
+    score2 INTEGER NOT NULL,
+    UNIQUE (date, team1, team2)
+);
+
+CREATE INDEX IF NOT EXISTS matches_team1_date ON matches (team1, date);
+CREATE INDEX IF NOT EXISTS matches_team2_date ON matches (team2, date);
+CREATE INDEX IF NOT EXISTS matches_league_season ON matches (country, league, season);
+CREATE INDEX IF NOT EXISTS matches_teams ON matches (team1, team2);
+
+CREATE TABLE IF NOT EXISTS future (
+    country TEXT NOT NULL,
+    league TEXT NOT NULL,
+    date INTEGER NOT NULL,
+    team1 TEXT NOT NULL,
+    team2 TEXT NOT NULL,
+    season INTEGER NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS future_league ON future (country, league);
+CREATE INDEX IF NOT EXISTS future_team1 ON future (team1);
+CREATE INDEX IF NOT EXISTS future_team2 ON future (team2);
+
+CREATE TABLE IF NOT EXISTS meetings (
+    team_a TEXT NOT NULL,
+    team_b TEXT NOT NULL,
+    wins_a INTEGER NOT NULL,
+    wins_b INTEGER NOT NULL,
+    draws INTEGER NOT NULL,
+    PRIMARY KEY (team_a, team_b)
+);
+
+CREATE TRIGGER IF NOT EXISTS matches_meetings AFTER INSERT ON matches BEGIN
+    INSERT OR IGNORE INTO meetings VALUES (MIN(NEW.team1, NEW.team2), MAX(NEW.team1, NEW.team2), 0, 0, 0);
+    UPDATE meetings SET
+        wins_a = wins_a + (CASE WHEN NEW.team1 < NEW.team2 THEN NEW.score1 > NEW.score2 ELSE NEW.score2 > NEW.score1 END),
+        wins_b = wins_b + (CASE WHEN NEW.team1 < NEW.team2 THEN NEW.score1 < NEW.score2 ELSE NEW.score2 < NEW.score1 END),
+        draws = draws + (NEW.score1 = NEW.score2)
+    WHERE team_a = MIN(NEW.team1, NEW.team2) AND team_b = MAX(NEW.team1, NEW.team2);
+END;
+
+CREATE TABLE IF NOT EXISTS streaks (
+    team TEXT PRIMARY KEY,
+    league TEXT NOT NULL,
+    country TEXT NOT NULL,
+    last_date INTEGER NOT NULL,
+    curr_series INTEGER NOT NULL,
+    max_series INTEGER NOT NULL,
+    sum_series INTEGER NOT NULL,
+    n_series INTEGER NOT NULL,
+    seen_draw INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS streaks_progress (
+    season_from INTEGER NOT NULL,
+    last_rowid INTEGER NOT NULL
+);
+"""
+
+# head-to-head totals of every unordered team pair, team_a < team_b
+build_meetings = """
+INSERT INTO meetings
+SELECT team_a, team_b, SUM(score_a > score_b), SUM(score_a < score_b), SUM(score_a = score_b) FROM (
+    SELECT team1 AS team_a, team2 AS team_b, score1 AS score_a, score2 AS score_b FROM matches WHERE team1 < team2
+    UNION ALL
+    SELECT team2, team1, score2, score1 FROM matches WHERE team2 < team1)
+GROUP BY team_a, team_b
+"""
+
+def _ordinal(date):
+    return datetime.strptime(date, "%Y-%m-%d").toordinal() if date else 0
+
+def _fold_streak(streak, matches):
+    # matches: (date, league, country, score, opponent_score) in date order.
+    # A series is the run of non-draw matches finished by a draw, a leading
+    # run without a draw before it is only counted if it is not empty.
+    league, country, last_date, curr_series, max_series, sum_series, n_series, seen_draw = streak
+
+    for date, league, country, score, opponent_score in matches:
+        if score == opponent_score:
+            if seen_draw or curr_series:
+                max_series = max(max_series, curr_series)
+                sum_series += curr_series
+                n_series += 1
+            seen_draw = True
+            curr_series = 0
+        else:
+            curr_series += 1
+        last_date = date
+
+    return Streak(league, country, last_date, curr_series, max_series, sum_series, n_series, seen_draw)
+
+empty_streak = Streak(None, None, 0, 0, 0, 0, 0, False)
+
+class MatchStore(object):
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        if version == 0 and self._has_table("matches"):
+            self._migrate_text_dates()
+
+        self.conn.executescript(schema)
+        self.conn.execute("PRAGMA user_version = {}".format(schema_version))
+
+        with self.conn:
+            if self.conn.execute("SELECT 1 FROM meetings LIMIT 1").fetchone() is None:
+                self.conn.execute(build_meetings)
+
+    def __enter__(self):
+        self.conn.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        return self.conn.__exit__(*args)
+
+    def close(self):
+        self.conn.close()
+
+    def _has_table(self, name):
+        query = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?"
+        return self.conn.execute(query, (name,)).fetchone() is not None
+
+    def _migrate_text_dates(self):
+        # stores written before version 1 kept dates as "%Y-%m-%d" strings and
+        # seasons as "YYYY/YY" names; the tables are rebuilt with integer columns
+        leagues = self.conn.execute("SELECT country, league, url, seasons, last_date FROM leagues").fetchall()
+        matches = self.conn.execute("SELECT country, league, date, team1, team2, season, score1, score2 FROM matches").fetchall()
+        future = self.conn.execute("SELECT country, league, date, team1, team2, season FROM future").fetchall()
+
+        self.conn.executescript("DROP TABLE leagues; DROP TABLE matches; DROP TABLE future; DROP TABLE IF EXISTS meetings;")
+        self.conn.executescript(schema)
+
+        with self.conn:
+            self.conn.executemany("INSERT INTO leagues VALUES (?, ?, ?, ?, ?)",
+                                  [(*row[:4], _ordinal(row[4])) for row in leagues])
+            self.conn.executemany("INSERT INTO matches VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                  [(*row[:2], _ordinal(row[2]), *row[3:5], int(row[5][:4]), *row[6:]) for row in matches])
+            self.conn.executemany("INSERT INTO future VALUES (?, ?, ?, ?, ?, ?)",
+                                  [(*row[:2], _ordinal(row[2]), *row[3:5], int(row[5][:4])) for row in future])
+
+    def is_empty(self):
+        return self.conn.execute("SELECT 1 FROM leagues LIMIT 1").fetchone() is None
+
+    def load_leagues(self):
+        # leagues tree without the match history, which stays in the store
+        leagues = dict()
+
+        for country, league, url, seasons, last_date in self.conn.execute(
+                "SELECT country, league, url, seasons, last_date FROM leagues"):
+            leagues.setdefault(country, dict())
+            leagues[country][league] = {"url" : url,
+                                        "seasons" : json.loads(seasons),
+                                        "last_date" : last_date,
+                                        "matches" : list()}
+
+        for country, league, date, team1, team2, season in self.conn.execute(
+                "SELECT country, league, date, team1, team2, season FROM future ORDER BY date"):
+            leagues[country][league].setdefault("future", list())
+            leagues[country][league]["future"].append(Fixture(date, team1, team2, season))
+
+        return leagues
+
+    def save_league(self, country, league, url, seasons, last_date):
+        self.conn.execute("INSERT OR REPLACE INTO leagues VALUES (?, ?, ?, ?, ?)",
+                          (country, league, url, json.dumps(seasons), last_date))
+
+    def add_matches(self, country, league, matches):
+        # already stored matches are ignored
+        cursor = self.conn.executemany("INSERT OR IGNORE INTO matches VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                       [(country, league, *match) for match in matches])
+        return cursor.rowcount
+
+    def set_future(self, country, league, fixtures):
+        self.conn.execute("DELETE FROM future WHERE country = ? AND league = ?", (country, league))
+        self.conn.executemany("INSERT INTO future VALUES (?, ?, ?, ?, ?, ?)",
+                              [(country, league, *fixture) for fixture in fixtures])
+
+    def matches_version(self):
+        # matches are only ever inserted, so the last rowid changes with every
+        # new match written by any connection
+        return self.conn.execute("SELECT COALESCE(MAX(rowid), 0) FROM matches").fetchone()[0]
+
+    def iter_matches(self):
+        # (country, league, Match), newest first
+        rows = self.conn.execute("SELECT country, league, date, team1, team2, season, score1, score2 "
+                                 "FROM matches ORDER BY date DESC")
+        return ((country, league, Match(*match)) for country, league, *match in rows)
+
+    def single_league_teams(self):
+        query = ("SELECT team FROM ("
+                 "  SELECT team1 AS team, country, league FROM matches"
+                 "  UNION SELECT team2, country, league FROM matches) "
+                 "GROUP BY team HAVING COUNT(*) = 1")
+        return set(row[0] for row in self.conn.execute(query))
+
+    def team_matches(self, team, date_to, season_from):
+        # TeamMatch list, newest first
+        query = ("SELECT league, country, team2, score1, score2, season, date FROM matches "
+                 "  WHERE team1 = ? AND date <= ? AND season >= ? "
+                 "UNION ALL "
+                 "SELECT league, country, team1, score2, score1, season, date FROM matches "
+                 "  WHERE team2 = ? AND date <= ? AND season >= ? "
+                 "ORDER BY date DESC")
+        return [TeamMatch(*row) for row in self.conn.execute(query, (team, date_to, season_from) * 2)]
+
+    def future_index(self):
+        # {team: TeamFixture list, nearest first} in one query
+        query = ("SELECT team1, league, country, team2, season, date FROM future "
+                 "UNION ALL "
+                 "SELECT team2, league, country, team1, season, date FROM future "
+                 "ORDER BY date")
+        index = dict()
+        for team, *fixture in self.conn.execute(query):
+            index.setdefault(team, list()).append(TeamFixture(*fixture))
+        return index
+
+    def max_team_future(self):
+        query = ("SELECT COALESCE(MAX(n), 0) FROM ("
+                 "  SELECT COUNT(*) AS n FROM ("
+                 "    SELECT team1 AS team FROM future UNION ALL SELECT team2 FROM future) "
+                 "  GROUP BY team)")
+        return self.conn.execute(query).fetchone()[0]
+
+    def update_streaks(self, season_from):
+        # Folds the matches stored since the last call into the draw streaks
+        # of the seasons from season_from on. Rows are new if their rowid is
+        # past the recorded one; a team is rebuilt from its history if a new
+        # match predates its last folded one, all teams if season_from moved.
+        progress = self.conn.execute("SELECT season_from, last_rowid FROM streaks_progress").fetchone()
+        last_rowid = 0
+        if progress is not None and progress[0] == season_from:
+            last_rowid = progress[1]
+
+        max_rowid = self.conn.execute("SELECT COALESCE(MAX(rowid), 0) FROM matches").fetchone()[0]
+        query = ("SELECT date, league, country, team1, team2, score1, score2 FROM matches "
+                 "WHERE rowid > ? AND season >= ? ORDER BY date")
+        new_matches = dict()
+        for date, league, country, team1, team2, score1, score2 in self.conn.execute(query, (last_rowid, season_from)):
+            new_matches.setdefault(team1, list()).append((date, league, country, score1, score2))
+            new_matches.setdefault(team2, list()).append((date, league, country, score2, score1))
+
+        streaks = self.streaks() if last_rowid else dict()
+        updated = list()
+        for team, matches in new_matches.items():
+            streak = streaks.get(team, empty_streak)
+            if matches[0][0] < streak.last_date:
+                matches = [(m.date, m.league, m.country, m.score, m.opponent_score)
+                           for m in reversed(self.team_matches(team, datetime.max.toordinal(), season_from))]
+                streak = empty_streak
+            updated.append((team, *_fold_streak(streak, matches)))
+
+        with self.conn:
+            if not last_rowid:
+                self.conn.execute("DELETE FROM streaks")
+            self.conn.executemany("INSERT OR REPLACE INTO streaks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", updated)
+            self.conn.execute("DELETE FROM streaks_progress")
+            self.conn.execute("INSERT INTO streaks_progress VALUES (?, ?)", (season_from, max_rowid))
+
+    def streaks(self):
+        # {team: Streak}
+        rows = self.conn.execute("SELECT team, league, country, last_date, curr_series, max_series, "
+                                 "sum_series, n_series, seen_draw FROM streaks")
+        return {team: Streak(*streak[:7], bool(streak[7])) for team, *streak in rows}
+
+    def meeting_index(self):
+        # {(team_a, team_b): (wins_a, wins_b, draws)} with team_a < team_b
+        rows = self.conn.execute("SELECT team_a, team_b, wins_a, wins_b, draws FROM meetings")
+        return {(team_a, team_b): (wins_a, wins_b, draws) for team_a, team_b, wins_a, wins_b, draws in rows}
@@ -1,12 +1,29 @@
+import os
 import re
-import time
+import sys
+import json
 import requests
+from io import BytesIO
 from datetime import datetime
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from difflib import SequenceMatcher
+from functools import partial
 
-from requests.sessions import Session
 from lxml.html import HtmlElement
-#from fuzzywuzzy import fuzz
-from lxml import html
+from lxml import etree, html
+
+try:
+    from fuzzywuzzy import fuzz
+    nameSimilarity = lambda a, b: fuzz.ratio(a, b) / 100.0
+except ImportError:
+    nameSimilarity = lambda a, b: SequenceMatcher(None, a, b).ratio()
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from crawler import HttpClient, AdaptiveRateLimiter, ResponseCache
+from metrics import metrics, profiled
+
+verbose = "--verbose" in sys.argv # per row and per match output of the crawl
 
 def requestHandler(func):
     def wrapper(*args, **kwargs):
@@ -23,41 +40,182 @@ def requestHandler(func):
             
     return wrapper
 
+# every (name, country) gets one integer id shared by all its instances
+leagueIds = dict()
+teamIds = dict()
+
 class League(object):
+    __slots__ = ("name", "country", "id")
+    
     def __init__(self, name:str, country:str):
         self.name = name
         self.country = country
+        self.id = leagueIds.setdefault((name, country), len(leagueIds))
         
     def __hash__(self):
-        return hash(self.__str__())
+        return self.id
     
     def __str__(self):
         return ".".join((str(self.name), str(self.country), "league"))
     
     def __eq__(self, other):
-        return self.name == other.name and self.country == other.country
+        return self.id == other.id
     
     def __ne__(self, other):
-        return not __eq__(self, other)
+        return not self.__eq__(other)
         
 class Team(object):
+    __slots__ = ("name", "country", "id")
+    
     def __init__(self, name:str, country:str):
         self.name = name
         self.country = country
+        self.id = teamIds.setdefault((name, country), len(teamIds))
         
     def __hash__(self):
-        return hash(self.__str__())
+        return self.id
     
     def __str__(self):
         return ".".join((str(self.name), str(self.country), "team"))
     
     def __eq__(self, other):
-        return self.name == other.name and self.country == other.country
+        return self.id == other.id
     
     def __ne__(self, other):
-        return not __eq__(self, other)
+        return not self.__eq__(other)
+        
+def NormalizeName(name: str) -> str:
+    return " ".join(name.lower().split()) if name else ""
+
+class Registry(object):
+    # Interns Team/League instances and indexes them by normalized name and by
+    # (name, country), aliases map spelling variants to the canonical name
+    def __init__(self, aliases=None):
+        self.aliases = aliases if aliases is not None else dict()
+        self.teams = dict()
+        self.teamsByName = dict()
+        self.leagues = dict()
+        self.leaguesByName = dict()
+        
+    def AddAlias(self, alias: str, name: str):
+        self.aliases[NormalizeName(alias)] = NormalizeName(name)
+        
+    def _key(self, name: str) -> str:
+        key = NormalizeName(name)
+        return self.aliases.get(key, key)
         
+    def _add(self, item, items: dict, itemsByName: dict):
+        key = (self._key(item.name), NormalizeName(item.country))
+        if key not in items:
+            items[key] = item
+            itemsByName.setdefault(key[0], list()).append(item)
+        return items[key]
+        
+    def AddTeam(self, team: Team) -> Team:
+        return self._add(team, self.teams, self.teamsByName)
+    
+    def AddLeague(self, league: League) -> League:
+        return self._add(league, self.leagues, self.leaguesByName)
+        
+    def Team(self, name: str, country: str) -> Team:
+        return self.AddTeam(Team(name, country))
+    
+    def League(self, name: str, country: str) -> League:
+        return self.AddLeague(League(name, country))
+        
+    def _find(self, name: str, items: dict, itemsByName: dict, country=None) -> list:
+        if country:
+            item = items.get((self._key(name), NormalizeName(country)))
+            return [item] if item else []
+        return list(itemsByName.get(self._key(name), []))
+        
+    def FindTeamByName(self, teamName: str, country=None) -> list:
+        return self._find(teamName, self.teams, self.teamsByName, country)
+    
+    def FindLeagueByName(self, leagueName: str, country=None) -> list:
+        return self._find(leagueName, self.leagues, self.leaguesByName, country)
+    
+class FuzzyResolver(object):
+    # Resolves team names that have no exact match in the registry. Candidates
+    # are blocked by country and character n-gram, only the teams sharing the
+    # most n-grams with the name are scored. Resolved names are memoized in
+    # memo, which may be shared; misses only hold for this registry and size.
+    def __init__(self, registry: Registry, memo=None, n=3, threshold=0.85, maxCandidates=10):
+        self.registry = registry
+        self.memo = memo if memo is not None else dict()
+        self.misses = dict() # (name, country) -> number of registry teams it was tried against
+        self.n = n
+        self.threshold = threshold
+        self.maxCandidates = maxCandidates
+        self.grams = dict()
+        self.indexed = set()
+        
+    def _grams(self, name: str) -> set:
+        name = " {} ".format(name)
+        return set(name[i:i + self.n] for i in range(max(len(name) - self.n + 1, 1)))
+    
+    def _index(self):
+        if len(self.indexed) == len(self.registry.teams):
+            return
         
+        for key, team in self.registry.teams.items():
+            if key in self.indexed:
+                continue
+                
+            self.indexed.add(key)
+            name, country = key
+            for gram in self._grams(name):
+                self.grams.setdefault((country, gram), set()).add(team)
+                self.grams.setdefault((None, gram), set()).add(team)
+        
+    def Resolve(self, teamName: str, country=None) -> Team:
+        candidates = self.registry.FindTeamByName(teamName, country)
+        if len(candidates) == 1:
+            return candidates[0]
+        
+        name = NormalizeName(teamName)
+        country = NormalizeName(country) if country else None
+        key = (name, country)
+        
+        if key in self.memo:
+            return self.memo[key]
+        if self.misses.get(key) == len(self.registry.teams):
+            return None
+        
+        with metrics.span("resolve"):
+            team = self._resolve(name, country)
+        
+        if team is None:
+            self.misses[key] = len(self.registry.teams)
+        else:
+            self.memo[key] = team
+        return team
+    
+    def _resolve(self, name: str, country: str) -> Team:
+        self._index()
+        shared = dict()
+        for gram in self._grams(name):
+            for team in self.grams.get((country, gram), ()):
+                shared[team] = shared.get(team, 0) + 1
+        
+        candidates = sorted(shared, key=lambda x: shared[x], reverse=True)[:self.maxCandidates]
+        scores = sorted(((nameSimilarity(name, NormalizeName(team.name)), team) for team in candidates),
+                        key=lambda x: x[0], reverse=True)
+        
+        team = None
+        if len(scores) and scores[0][0] >= self.threshold:
+            # a tie between different teams is ambiguous
+            if len(scores) == 1 or scores[1][0] < scores[0][0]:
+                team = scores[0][1]
+
+        return team
+    
+teamAliases = dict()
+resolvedTeamNames = dict()
+registry = Registry(teamAliases)
+        
+SeasonViolation = namedtuple("SeasonViolation", ("reason", "league", "team"))
+
 class Season(object):
     def __init__(self, year1, year2): #leagues=set(), teams=set(), leaguesTeams=list()):
         self.name = "/".join((str(year1), str(year2)[2:]))
@@ -66,31 +224,45 @@ class Season(object):
         self.leagues = set()#leagues
         self.teams = set()#teams
         self.leaguesTeams = list()#leaguesTeams
+        self.leagueTeams = dict() # league -> set of teams
+        self.teamLeagues = dict() # team -> set of leagues
+        self.registry = Registry(teamAliases)
+        self.resolver = FuzzyResolver(self.registry, resolvedTeamNames)
         
     def AddTeam(self, team: Team, league: League):
+        self.registry.AddTeam(team)
         self.teams.add(team)
         self.leagues.add(league)
         self.leaguesTeams.append((league, team))
+        self.leagueTeams.setdefault(league, set()).add(team)
+        self.teamLeagues.setdefault(team, set()).add(league)
         
-    def Check(self) -> (bool, str):
-        for item in self.leaguesTeams:
-            league, team = item
-            if league not in self.leagues:
-                return False, "{} not in leagues".format(league)
-            
-            if team not in self.teams:
-                return False, "{} not in teams".format(team)
-            
-        for league in self.leagues:
-            if len([i[0] for i in self.leaguesTeams if i[0] == league]) != 1:
-                return False, ""
-            
-        for team in self.teams:
-            if len([i[1] for i in self.leaguesTeams if i[1] == team]) != 1:
-                return False
+    def DropTeams(self, teams: set):
+        # leagues left without teams are dropped as well
+        for team in teams:
+            for league in self.teamLeagues.pop(team, ()):
+                self.leagueTeams[league].discard(team)
+                if not self.leagueTeams[league]:
+                    del self.leagueTeams[league]
+                    self.leagues.discard(league)
+            self.teams.discard(team)
             
+        self.leaguesTeams = [(league, team) for league, team in self.leaguesTeams if team not in teams]
+        
+    def Check(self) -> (bool, list):
+        # every team plays in exactly one league
+        violations = list()
+        
+        for team, leagues in self.teamLeagues.items():
+            if len(leagues) != 1:
+                for league in leagues:
+                    violations.append(SeasonViolation("team in {} leagues".format(len(leagues)), league, team))
+                
+        return len(violations) == 0, violations
 
 class Match(object):
+    __slots__ = ("team1", "team2", "date", "team1Score", "team2Score", "flags", "hash")
+    
     def __init__(self, team1: Team, team2: Team, date:datetime, team1Score:int, team2Score:int, flags=0):
         self.team1 = team1
         self.team2 = team2
@@ -98,21 +270,25 @@ class Match(object):
         self.team1Score = team1Score
         self.team2Score = team2Score
         self.flags = flags
+        self.hash = hash(self.Key())
         
     def __str__(self):
         return ".".join((str(self.team1), str(self.team2), str(self.date.strftime("%Y-%m-%d")), str(self.team1Score), str(self.team2Score)))
     
+    def Key(self) -> tuple:
+        # identity independent of the side the match was listed from
+        side1 = (self.team1.id, self.team1Score)
+        side2 = (self.team2.id, self.team2Score)
+        return (self.date, self.flags) + (side1 + side2 if side1 <= side2 else side2 + side1)
+    
     def __hash__(self):
-        return hash(self.__str__())
+        return self.hash
     
     def __eq__(self, other):
-        selfTuple  = (self.team1, self.team2, self.date, self.team1Score, self.team2Score, self.flags)
-        selfTuple2 = (self.team2, self.team1, self.date, self.team2Score, self.team1Score, self.flags)
-        otherTuple = (other.team1, other.team2, other.date, other.team1Score, other.team2Score, other.flags)
-        return (selfTuple == otherTuple) or (selfTuple2 == otherTuple)
+        return self.hash == other.hash and self.Key() == other.Key()
     
     def __ne__(self, other):
-        return not __eq__(self, other)
+        return not self.__eq__(other)
         
 def packMatchFlags(isLeague, isCup, isPlayoff, isFriendly, isUpperDivision, isLowerDivision):
     flags = 1 # lower bit always set to 1, to check that flags was initialized
@@ -167,42 +343,86 @@ def isLowerDivision(match):
 def isInternational(match):
     return int(match.team1.country != match.team2.country)
 
+def isSeasonClosed(year2: int) -> bool:
+    return datetime.now() >= datetime(year2, 7, 1)
+
 def getSeason(date):
     currentYear = date.year
     if date.month <= 6:
         return "/".join((str(currentYear-1)[2:],str(currentYear)[2:]))
     return "/".join((str(currentYear)[2:],str(currentYear+1)[2:]))
 
-def FindTeamByName(teamName:str, teams: list, country=None) -> list:
-    candidates = list()
-    
-    if country:
-        candidates = filter(lambda x: teamName.lower() == x.name.lower() and x.country.lower() == country.lower(), teams)
-        return list(set(candidates))
-    
-    candidates = filter(lambda x: teamName.lower() == x.name.lower(), teams)
-    return list(set(candidates))
-    
-def FindLeagueByName(leagueName: str, leagues:list, country=None) -> list:
-    candidates = list()
+def FindLeagueByTeam(team: Team, season: Season) -> list:
+    return list(season.teamLeagues.get(team, ()))
     
-    if country:
-        candidates = filter(lambda x: x.name.lower() == leagueName.lower() and x.country.lower() == country.lower(), leagues)
-        return list(set(candidates))
+class CrawlJournal(object):
+    # Append-only log of completed crawl units, one json record per line:
+    # the leagues list, the teams of a league season and the parsed matches of
+    # a team page. A restarted crawl skips the recorded units, an offline
+    # journal never fetches and serves only what was recorded.
+    def __init__(self, path: str, offline=False):
+        self.path = path
+        self.offline = offline
+        self.units = dict()
+        
+        size = 0
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                for line in f:
+                    # a torn last record of a killed crawl may still parse,
+                    # only newline terminated records are complete
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    self.units[tuple(record["unit"])] = record["data"]
+                    size += len(line)
+                    
+        self.file = None
+        if not offline:
+            self.file = open(path, "a", encoding="utf-8")
+            self.file.truncate(size)
+        
+    def Get(self, *unit):
+        return self.units.get(unit)
     
-    candidates = filter(lambda x: x.name.lower() == leagueName.lower(), leagues)
-    return list(set(candidates))
+    def Record(self, data, *unit):
+        self.units[unit] = data
+        if self.file is None:
+            return
+        
+        self.file.write(json.dumps({"unit": unit, "data": data}, ensure_ascii=False) + "\n")
+        self.file.flush()
+        
+    def Close(self):
+        if self.file is not None:
+            self.file.close()
+            
+def DumpMatch(m: Match) -> list:
+    return [m.team1.name, m.team1.country, m.team2.name, m.team2.country,
+            m.date.strftime("%Y-%m-%d"), m.team1Score, m.team2Score, m.flags]
+
+def LoadMatch(data: list) -> Match:
+    team1Name, team1Country, team2Name, team2Country, date, team1Score, team2Score, flags = data
+    return Match(registry.Team(team1Name, team1Country), registry.Team(team2Name, team2Country),
+                 datetime.strptime(date, "%Y-%m-%d"), team1Score, team2Score, flags)
 
-def FindLeagueByTeam(team: Team, season: Season) -> list:
-    result = filter(lambda x: x[1] == team, season.leaguesTeams)
-    result = [i[0] for i in result]
-    return list(set(result))
-    
 requests.packages.urllib3.disable_warnings()
 userAgent = "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:79.0) Gecko/20100101 Firefox/79.0"
-sess = requests.Session()
-sess.headers.update({"User-Agent":userAgent})
-sess.get = requestHandler(sess.get)
+requestsPerSecond = 5.0 # global budget, the per host rate adapts below it
+prefetchPages = 4 # pages fetched ahead while the previous ones are parsed
+cacheDir = "cache"
+cacheTtl = 6 * 60 * 60 # seconds before pages of the current season are revalidated
+responseCache = ResponseCache(cacheDir, cacheTtl)
+journalFile = "crawl.journal"
+metricsFile = "soccer-v2-metrics.json"
+profileFile = "soccer-v2.prof"
+
+rateLimiter = AdaptiveRateLimiter(1.0, requestsPerSecond, budget=requestsPerSecond)
+sess = HttpClient(headers={"User-Agent":userAgent}, limiter=rateLimiter)
+sess.get = requestHandler(metrics.timed("fetch", partial(responseCache.fetch, sess.get)))
 
 def AddUrlParams(url:str, **kwargs) -> str:
     sep = "?"
@@ -243,10 +463,21 @@ def NormalizeSeasonName(name: str) -> str:
     
     return name
 
-def LoadLeagues(url: str, sess:Session, timeout=5) -> (list, dict):
+def LoadLeagues(url: str, sess:HttpClient, timeout=5, journal: CrawlJournal=None) -> (list, dict):
     leagues = list()
     leaguesPathes = dict()
     
+    recorded = journal.Get("leagues", url) if journal else None
+    if recorded is not None:
+        for leagueName, country, leagueLink in recorded:
+            league = registry.League(leagueName, country)
+            leaguesPathes[league] = leagueLink
+            leagues.append(league)
+        return leagues, leaguesPathes
+    
+    if journal and journal.offline:
+        return leagues, leaguesPathes
+    
     r, err = sess.get(url, verify=False, timeout=timeout)
     if err:
         return leagues, leaguesPathes
@@ -266,30 +497,34 @@ def LoadLeagues(url: str, sess:Session, timeout=5) -> (list, dict):
         anchor = anchor[0]
         leagueName = anchor.text
         leagueLink = anchor.attrib["href"]
-        league = League(leagueName, country)
+        league = registry.League(leagueName, country)
         
         if checkLeague(league): # TODO Remove this check with something appropriate
             leaguesPathes[league] = leagueLink
             leagues.append(league)
     
+    if journal:
+        journal.Record([[league.name, league.country, leaguesPathes[league]] for league in leagues], "leagues", url)
+    
     return leagues, leaguesPathes
 
 extractDataKeyRe = re.compile('''\"data_key\"\s*\:\s*\"([^\"]+)\"''')
 baseUrl = "https://24score.pro/"
 backendLoadPageDataUrl = JoinUrlPath(baseUrl, "/backend/load_page_data.php")
 
-def LoadLeagueTeams(url: str, timeout=5) -> (list, list):
+def LoadLeagueTeams(url: str, timeout=5, final=False) -> (list, list):
+    # returns None if the standings could not be loaded
     teamNames = list()
     teamPathes = list()
     
-    r, err = sess.get(url, verify=False, timeout=timeout)
+    r, err = sess.get(url, final=final, verify=False, timeout=timeout)
     if err:
-        return [], []
+        return None
     
     dataKey = re.findall(extractDataKeyRe, r.text)
     if len(dataKey) == 0:
         print("Could not load data from page {}".format(url))
-        return [], []
+        return None
         
     assert(len(dataKey) == 1)
     dataKey = dataKey[0]
@@ -299,16 +534,16 @@ def LoadLeagueTeams(url: str, timeout=5) -> (list, list):
         "Referer": url, 
     }
     
-    r, err = sess.get(newUrl, headers=headers, verify=False, timeout=timeout)
+    r, err = sess.get(newUrl, final=final, headers=headers, verify=False, timeout=timeout)
     if err:
-        return [], []
+        return None
     
     doc = html.fromstring(r.text)
     standingsTable = doc.xpath(".//div[contains(@class,\"data_0_all\")]")
 
     if len(standingsTable) == 0:
         print("Could not get teams for the league on page {}".format(url))
-        return [], []
+        return None
         
     assert(len(standingsTable) == 1)
     standingsTable = standingsTable[0]
@@ -325,48 +560,86 @@ def LoadLeagueTeams(url: str, timeout=5) -> (list, list):
     return teamNames, teamPathes
     
     
-def LoadSeason(leaguesPathes: dict, year1: int, year2:int, timeout=5, delay=1) -> (Season, dict):
+def LoadLeagueSeason(leaguePath: str, seasonName: str, seasonClosed: bool, timeout=5) -> (str, list, list):
+    leagueUrl = JoinUrlPath(baseUrl, leaguePath)
+    r, err = sess.get(leagueUrl, verify=False, timeout=timeout)
+    if err:
+        return None
+        
+    doc = html.fromstring(r.text)
+    
+    seasonLinkPath = ""
+    options = doc.xpath(".//select[@class=\"sel_season\"]/option")
+    for opt in options:
+        if seasonName == NormalizeSeasonName(opt.text):
+            assert("value" in opt.attrib)
+            seasonLinkPath = opt.attrib["value"]
+
+    if seasonLinkPath == "":
+        print("Could not get link for {} on page {}".format(seasonName, leagueUrl))
+        return None
+        
+    seasonLink = JoinUrlPath(baseUrl, seasonLinkPath)
+    leagueTeams = LoadLeagueTeams(seasonLink, final=seasonClosed)
+    if leagueTeams is None:
+        return None # not journaled, so a resumed crawl retries the league
+    
+    leagueTeamNames, teamLinks = leagueTeams
+    return seasonLinkPath, leagueTeamNames, teamLinks
+    
+def LoadSeason(leaguesPathes: dict, year1: int, year2:int, timeout=5, journal: CrawlJournal=None) -> (Season, dict):
     assert(year2 > year1)
     season = Season(year1, year2)
     seasonLeaguesPathes = dict()
 
-    seasonName = season.name
     teamPathes = dict()
+    leagues = list(leaguesPathes)
+    loadLeagueSeason = lambda league: LoadLeagueSeason(leaguesPathes[league], season.name, isSeasonClosed(year2), timeout)
+    leagueUnit = lambda league: ("league", season.name, league.country, league.name)
+    
+    leagueSeasons = dict()
+    if journal:
+        for league in leagues:
+            recorded = journal.Get(*leagueUnit(league))
+            if recorded is not None:
+                leagueSeasons[league] = tuple(recorded)
+                
+    missing = [league for league in leagues if league not in leagueSeasons]
+    if journal and journal.offline:
+        missing = []
 
-    for league in leaguesPathes:
-        leagueUrl = JoinUrlPath(baseUrl, leaguesPathes[league])
-        r, err = sess.get(leagueUrl, verify=False, timeout=timeout)
-        if err:
+    with ThreadPoolExecutor(max_workers=prefetchPages) as pool:
+        for league, leagueSeason in zip(missing, pool.map(loadLeagueSeason, missing)):
+            leagueSeasons[league] = leagueSeason
+            if journal and leagueSeason is not None:
+                journal.Record(leagueSeason, *leagueUnit(league))
+
+    for league in leagues:
+        leagueSeason = leagueSeasons.get(league)
+        if leagueSeason is None:
             continue
             
-        doc = html.fromstring(r.text)
-        
-        seasonLinkPath = ""
-        options = doc.xpath(".//select[@class=\"sel_season\"]/option")
-        for opt in options:
-            if seasonName == NormalizeSeasonName(opt.text):
-                assert("value" in opt.attrib)
-                seasonLinkPath = opt.attrib["value"]
-
-        if seasonLinkPath == "":
-            print("Could not get link for {} on page {}".format(seasonName, leagueUrl))
-            continue 
-            
+        seasonLinkPath, leagueTeamNames, teamLinks = leagueSeason
         seasonLeaguesPathes[league] = seasonLinkPath           
-        seasonLink = JoinUrlPath(baseUrl, seasonLinkPath)
-        leagueTeamNames, teamLinks = LoadLeagueTeams(seasonLink)
-        time.sleep(delay)
         
         assert(len(leagueTeamNames) == len(teamLinks))
         for i in range(len(leagueTeamNames)):
             teamName = leagueTeamNames[i]
-            team = Team(teamName, league.country)
+            team = registry.Team(teamName, league.country)
             teamPathes[team] = teamLinks[i]
             season.AddTeam(team, league)
+    
+    # a failed check would fail the same way on every resume from the
+    # journal, so the offending teams are left out of the season instead
+    ok, violations = season.Check()
+    for v in violations:
+        print("Season {} check: {} {} {}, team dropped".format(season.name, v.reason, v.league, v.team))
+    if not ok:
+        season.DropTeams(set(v.team for v in violations))
             
     return season, teamPathes, seasonLeaguesPathes
 
-    matchRe = re.compile("(\d{2}\.\d{2}\.\d{4})\s*([^\-]+)\-\s*([^\d]+)\s*(\d)\:(\d)")
+matchRe = re.compile("(\d{2}\.\d{2}\.\d{4})\s*([^\-]+)\-\s*([^\d]+)\s*(\d+)\:(\d+)")
 
 def GetAllTextFromHtmlElement(node: HtmlElement, filterFunc=None) -> list:
     text = list()
@@ -402,23 +675,33 @@ def MatchFilterFunc(text):
     
     return ""
 
-def ParseLeagueMatchTable(table: HtmlElement, teams: list) -> list:
+def GetRowText(row: HtmlElement) -> str:
+    # text of all cells of the row with whitespace collapsed once
+    return " ".join(" ".join(text for node in row.iter("td") for text in node.itertext()).split())
+
+def ParseLeagueMatchTable(table: HtmlElement, teams: FuzzyResolver, country=None, seenRows=None) -> list:
+    # rows in seenRows were already parsed from the page of the opponent
     matches = set()
+    nRows, nSeen, nRejected, nUnresolved = 0, 0, 0, 0
     
-    for match in table.xpath(".//tr"):
-        nodes = match.xpath(".//td")
-        if len(nodes) == 0:
+    for match in table.iter("tr"):
+        matchText = GetRowText(match)
+        if not matchText:
             continue
-      
-        nodeTexts = list()
-        for node in nodes:
-            nodeTexts.append(GetAllTextFromHtmlElement(node, MatchFilterFunc))
+        
+        if seenRows is not None:
+            if matchText in seenRows:
+                nSeen += 1
+                continue
+            seenRows.add(matchText)
     
-        matchText = "".join(nodeTexts)
-        matchParams = re.findall(matchRe, matchText)
+        nRows += 1
+        matchParams = matchRe.findall(matchText)
         
         if len(matchParams) != 1:
-            print("Could not parse \"{}\"".format(matchText))
+            nRejected += 1
+            if verbose:
+                print("Could not parse \"{}\"".format(matchText))
             continue
             
         assert(len(matchParams) == 1)
@@ -430,133 +713,257 @@ def ParseLeagueMatchTable(table: HtmlElement, teams: list) -> list:
         team1Score = int(team1Score)
         team2Score = int(team2Score)
         
-        team1 = FindTeamByName(team1Name, teams)
+        team1 = teams.Resolve(team1Name, country)
   
-        if len(team1) != 1:
-            print("Could not find team1:", team1Name, " ", matchText)
+        if team1 is None:
+            nUnresolved += 1
+            if verbose:
+                print("Could not find team1:", team1Name, " ", matchText)
             continue
-                    
-        # assert(len(team1) == 1)
-        team1 = team1[0]
                 
-        team2 = FindTeamByName(team2Name, teams)
-        if len(team2) != 1:
-            print("Could not find team2:", team2Name, " ", matchText)
+        team2 = teams.Resolve(team2Name, country)
+        if team2 is None:
+            nUnresolved += 1
+            if verbose:
+                print("Could not find team2:", team2Name, " ", matchText)
             continue
                     
-        # assert(len(team2) == 1)
-        team2 = team2[0]    
         matchFlag = packMatchFlags(True, *([False]*5)) # assume league
         
         m = Match(team1, team2, date, team1Score, team2Score, matchFlag)
         matches.add(m)
-        
-    return list(matches)
     
-def LoadTeamMatches(season:Season, teamPathes:dict, leaguesPathes:dict, timeout=5, delay=0.2) -> list:
-    matches = set()
-    seasonName = season.name # YYYY/YY
+    metrics.count("rows_parsed", nRows)
+    metrics.count("rows_seen", nSeen)
+    metrics.count("rows_rejected", nRejected)
+    metrics.count("rows_unresolved", nUnresolved)
+    return list(matches)
     
-    for team in teamPathes:
-        if team not in season.teams:
+def IterTeamPage(content: bytes):
+    # Streams a team page from the raw response: yields the season <option>s
+    # of select.sel_season followed by the select itself once it is closed,
+    # and the match tables of div#all0 in page order, every table is
+    # cleared once the consumer is done with it
+    for event, elem in etree.iterparse(BytesIO(content), events=("end",), tag=("option", "select", "table"), html=True):
+        parent = elem.getparent()
+        if parent is None:
+            continue
+            
+        if elem.tag == "select":
+            if elem.get("class") == "sel_season":
+                yield elem
+            continue
+            
+        if elem.tag == "option":
+            if parent.tag == "select" and parent.get("class") == "sel_season":
+                yield elem
             continue
             
-        league = FindLeagueByTeam(team, season)
-        #print([str(i) for i in league])
+        if parent.tag == "div" and parent.get("id") == "all0":
+            yield elem
+            elem.clear()
+            while elem.getprevious() is not None:
+                del parent[0]
+
+def FindSeasonLink(elements, seasonName: str) -> str:
+    # consumes the page up to the end of the season select wherever it is,
+    # match tables before it are skipped
+    seasonLinkPath = ""
+    for elem in elements:
+        if elem.tag == "select":
+            break
         
-        assert(len(league) == 1)
-        league = league[0]
+        if elem.tag == "option" and seasonName == NormalizeSeasonName(elem.text):
+            assert("value" in elem.attrib)
+            seasonLinkPath = elem.attrib["value"]
             
-        url = JoinUrlPath(baseUrl, teamPathes[team])
-        r, err = sess.get(url, verify=False, timeout=timeout)  
-        if err:
+    return seasonLinkPath
+
+def LoadTeamPage(teamPath: str, seasonName: str, seasonClosed: bool, timeout=5) -> bytes:
+    # returns the team page of the season, the page is parsed again by the
+    # caller as an iterparse may not move between threads
+    url = JoinUrlPath(baseUrl, teamPath)
+    r, err = sess.get(url, verify=False, timeout=timeout)  
+    if err:
+        return None
+        
+    elements = IterTeamPage(r.content)
+    seasonLinkPath = FindSeasonLink(elements, seasonName)
+    elements.close()
+
+    if seasonLinkPath == "":
+        print("Could not get link for {} on page {}".format(seasonName, url))
+        return None
+
+    seasonLink = JoinUrlPath(baseUrl, seasonLinkPath)
+    if seasonLink == url:
+        return r.content
+    
+    if verbose:
+        print(url, seasonLink)
+    r, err = sess.get(seasonLink, final=seasonClosed, verify=False, timeout=timeout)
+    if err:
+        return None
+    return r.content
+
+def IterTeamPageTables(content: bytes):
+    return (elem for elem in IterTeamPage(content) if elem.tag == "table")
+
+def PlanTeamPages(season: Season, teams: list, covered: set) -> list:
+    # A team page lists every league match of the team, so the matches of a
+    # team are known once the pages of all its league opponents are loaded:
+    # a league season of n teams is covered by n - 1 pages. covered are the
+    # teams whose pages are already loaded.
+    teamLeagues = dict()
+    leagueTeams = dict()
+    for league, team in season.leaguesTeams:
+        teamLeagues[team] = league
+        leagueTeams.setdefault(league, list()).append(team)
+    
+    planned = list()
+    loaded = set(covered)
+    for team in teams:
+        if team in loaded:
             continue
+        
+        opponents = leagueTeams[teamLeagues[team]]
+        if all(opponent in loaded for opponent in opponents if opponent != team):
+            continue
+        
+        planned.append(team)
+        loaded.add(team)
+        
+    return planned
+
+def LoadTeamMatches(season:Season, teamPathes:dict, leaguesPathes:dict, timeout=5, journal: CrawlJournal=None) -> list:
+    matches = set()
+    seasonName = season.name # YYYY/YY
+    seasonClosed = isSeasonClosed(season.year2)
+    teams = [team for team in teamPathes if team in season.teams]
+    loadTeamPage = lambda team: LoadTeamPage(teamPathes[team], seasonName, seasonClosed, timeout)
+    teamUnit = lambda team: ("team", seasonName, team.country, team.name)
+    covered = set()
+    seenRows = set()
+    
+    if journal:
+        for team in teams:
+            recorded = journal.Get(*teamUnit(team))
+            if recorded is not None:
+                matches.update(LoadMatch(m) for m in recorded)
+                covered.add(team)
+        if journal.offline:
+            teams = list()
+    
+    # pages are fetched ahead by the pool while the main thread parses, the
+    # second pass replans the teams left uncovered by failed pages
+    with ThreadPoolExecutor(max_workers=prefetchPages) as pool:
+        for _ in range(2):
+            planned = PlanTeamPages(season, teams, covered)
             
-        doc = html.fromstring(r.text)
-        time.sleep(delay)
+            for team, content in zip(planned, pool.map(loadTeamPage, planned)):
+                if content is None:
+                    continue
+                    
+                league = FindLeagueByTeam(team, season)
                 
-        seasonLinkPath = ""
-        options = doc.xpath(".//select[@class=\"sel_season\"]/option")
-        for opt in options:
-            if seasonName == NormalizeSeasonName(opt.text):
-                assert("value" in opt.attrib)
-                seasonLinkPath = opt.attrib["value"]
-
-        if seasonLinkPath == "":
-            print("Could not get link for {} on page {}".format(seasonName, url))
-            continue 
-
-        seasonLink = JoinUrlPath(baseUrl, seasonLinkPath)
-        if seasonLink != url:
-            print(url, seasonLink)
-            r, err = sess.get(seasonLink, verify=False, timeout=timeout)
-            if err:
-                continue
+                assert(len(league) == 1)
+                league = league[0]
                 
-            doc = html.fromstring(r.text)
-            time.sleep(delay)
-            
-        matchTables = doc.xpath(".//div[@id=\"all0\"]/table")
+                # the tables are parsed while they are consumed, parse includes resolve
+                with metrics.span("parse"):
+                    matchTables = IterTeamPageTables(content)
+                    teamMatches = LoadLeagueTableMatches(matchTables, season, league, leaguesPathes, seenRows)
+                if journal:
+                    journal.Record([DumpMatch(m) for m in teamMatches], *teamUnit(team))
+                    
+                covered.add(team)
+                with metrics.span("merge"):
+                    matches.update(teamMatches)
+                
+    return list(matches)
+
+def LoadLeagueTableMatches(matchTables, season: Season, league: League, leaguesPathes: dict, seenRows=None) -> set:
+    matches = set()
+    
+    for table in matchTables:
+        anchor = table.xpath(".//tr/th/a")
+        if len(anchor) == 0:
+            continue
         
-        for table in matchTables:
-            anchor = table.xpath(".//tr/th/a")
-            if len(anchor) == 0:
-                continue
+        assert(len(anchor) == 1)
+        anchor = anchor[0]
         
-            assert(len(anchor) == 1)
-            anchor = anchor[0]
-            
-            assert("href" in anchor.attrib)
-            tLink = anchor.attrib["href"]
-            tName = anchor.text
-            
-            if tLink != leaguesPathes[league]:
+        assert("href" in anchor.attrib)
+        tLink = anchor.attrib["href"]
+        tName = anchor.text
+        
+        if tLink != leaguesPathes[league]:
+            if verbose:
                 print(tLink, leaguesPathes[league])
-                continue
-                
-            # assert(tLink == leaguesPathes[league])
-            teamLeagueMatches = ParseLeagueMatchTable(table, season.teams)
+            continue
             
+        # assert(tLink == leaguesPathes[league])
+        teamLeagueMatches = ParseLeagueMatchTable(table, season.resolver, league.country, seenRows)
+        
+        if verbose:
             for m in teamLeagueMatches:
                 print(m)
-                
-            if teamLeagueMatches == None:
-                print("Some strange error happened on", tLink," for ", tName)
-                continue
-                
-            matches.update(set(teamLeagueMatches))
-                
-    return list(matches)
+            
+        if teamLeagueMatches == None:
+            print("Some strange error happened on", tLink," for ", tName)
+            continue
+            
+        matches.update(set(teamLeagueMatches))
+            
+    return matches
 
-def LoadSeasonMatches(year1:int, year2:int, leagues:list, leaguesPathes:dict) -> (Season, list):
-    season, teamPathes, seasonLeaguePathes = LoadSeason(leaguesPathes, year1, year2)
-    print(seasonLeaguePathes)
+def LoadSeasonMatches(year1:int, year2:int, leagues:list, leaguesPathes:dict, journal: CrawlJournal=None) -> (Season, list):
+    season, teamPathes, seasonLeaguePathes = LoadSeason(leaguesPathes, year1, year2, journal=journal)
+    if verbose:
+        print(seasonLeaguePathes)
 
-    matches = LoadTeamMatches(season, teamPathes, seasonLeaguePathes)
+    matches = LoadTeamMatches(season, teamPathes, seasonLeaguePathes, journal=journal)
     
     return matches, season
 
 def GetDrawSeries(teamMatches: list) -> (list, tuple):
-    teamMatches = sorted(teamMatches, key=lambda x: x.date)
+    # teamMatches are sorted by date, as IndexTeamMatches leaves them
     drawSeries = list()   
     currentSeries = 0 # TODO: Get data from past season
     
     for tm in teamMatches:
         if tm.team1Score == tm.team2Score:
             drawSeries.append((currentSeries, tm.date, tm.team1Score))
-            print(drawSeries[-1])
+            if verbose:
+                print(drawSeries[-1])
             currentSeries = 0
         else:
             currentSeries += 1
         
     return drawSeries, (currentSeries, teamMatches[-1].date)
     
-def GetTeamsDrawSeries(seasons, matches) -> (dict, list):
+def IndexTeamMatches(matches) -> dict:
+    # team -> matches of the team sorted by date, in one pass over matches
+    teamsMatches = dict()
+    
+    for m in set(matches):
+        teamsMatches.setdefault(m.team1, list()).append(m)
+        teamsMatches.setdefault(m.team2, list()).append(m)
+        
+    for teamMatches in teamsMatches.values():
+        teamMatches.sort(key=lambda x: x.date)
+        
+    return teamsMatches
+    
+def GetTeamsDrawSeries(seasons, matches, teamsMatches=None) -> (dict, list):
     selectedTeams = set()
     selectedLeagues = set()
     teamsDrawSeries = dict()
     teamsLastSeries = list()
     
+    if teamsMatches is None:
+        teamsMatches = IndexTeamMatches(matches)
+    
     # sort seasons by years, first is the last
     seasons = sorted(seasons, key=lambda x: x.year2, reverse=True)
     
@@ -564,15 +971,15 @@ def GetTeamsDrawSeries(seasons, matches) -> (dict, list):
         selectedLeagues.update(s.leagues)
         
     for league in selectedLeagues:
-        leagueTeams = set([i[1] for i in filter(lambda x: x[0] == league, seasons[0].leaguesTeams)])
+        leagueTeams = set(seasons[0].leagueTeams.get(league, ()))
         
         for s in seasons[1:]:
-            leagueTeams = leagueTeams.intersection(set([i[1] for i in filter(lambda x: x[0] == league, s.leaguesTeams)]))
+            leagueTeams.intersection_update(s.leagueTeams.get(league, ()))
         
         selectedTeams.update(leagueTeams)
         
     for team in selectedTeams:
-        teamMatches = list(set(filter(lambda x: x.team1 == team or x.team2 == team, matches)))
+        teamMatches = teamsMatches.get(team, [])
         
         if len(teamMatches) == 0:
             print("No team matches for: ", team)
@@ -583,10 +990,44 @@ def GetTeamsDrawSeries(seasons, matches) -> (dict, list):
         
     return teamsDrawSeries
 
+def GetTeamsDrawStat(matches: list) -> dict:
+    from columnar import MatchTable
+    
+    rows = ((m.team1, m.team2, m.date.toordinal(), m.team1Score, m.team2Score, m.date.year - (m.date.month <= 6), None) for m in matches)
+    table = MatchTable.from_rows(rows)
+    stat = table.draw_stat()
+    teamsDrawStat = dict()
+    
+    for i, teamId in enumerate(stat["team"]):
+        teamsDrawStat[table.teams[teamId]] = {
+            "maxSeries": int(stat["max_series"][i]),
+            "meanSeries": float(stat["mean_series"][i]),
+            "currentSeries": int(stat["curr_series"][i]),
+            "drawRate": float(stat["draw_rate"][i]),
+        }
+        
+    return teamsDrawStat
+
 def main():
-    matches1, s1 = LoadSeasonMatches(2019, 2020, selectedLeagues, selectedLeaguesPathes)
-    matches2, s2 = LoadSeasonMatches(2018, 2019, selectedLeagues, selectedLeaguesPathes)
-    matches3, s3 = LoadSeasonMatches(2017, 2018, selectedLeagues, selectedLeaguesPathes)
+    # --profile dumps the cProfile stats of the run to profileFile and adds
+    # the tracemalloc peak to metricsFile
+    isProfiled = "--profile" in sys.argv
+    with profiled(profileFile if isProfiled else None, isProfiled) as memory:
+        Run()
+        
+    metrics.write(metricsFile, http=sess.stats(), cache=responseCache.stats(), memory=memory)
+    
+def Run():
+    # --offline rebuilds the statistics from the journal without any request
+    journal = CrawlJournal(journalFile, offline="--offline" in sys.argv)
+    try:
+        selectedLeagues, selectedLeaguesPathes = LoadLeagues(baseUrl, sess, journal=journal)
+        
+        matches1, s1 = LoadSeasonMatches(2019, 2020, selectedLeagues, selectedLeaguesPathes, journal)
+        matches2, s2 = LoadSeasonMatches(2018, 2019, selectedLeagues, selectedLeaguesPathes, journal)
+        matches3, s3 = LoadSeasonMatches(2017, 2018, selectedLeagues, selectedLeaguesPathes, journal)
+    finally:
+        journal.Close()
 
     allMatches = set()
     allMatches.update(matches1)
@@ -594,7 +1035,8 @@ def main():
     allMatches.update(matches3)
 
     seasons=[s1, s2, s3]
-    tds = GetTeamsDrawSeries([s1,s2,s3], list(allMatches))
+    with metrics.span("analyze"):
+        tds = GetTeamsDrawSeries(seasons, allMatches)
 
     for team in tds:
         ls = tds[team][-1]
@@ -603,6 +1045,8 @@ def main():
         league = league[0]
     
         print("\t".join((team.country,league.name, team.name, str(max([i[0] for i in ds])), str(ls[0]))))
+        
+    print(sess.stats())
 
 if __name__ == "__main__":
     main()
\ No newline at end of file